@@ -2,9 +2,171 @@
 import os
 import json
 import hashlib
-from datetime import datetime
-from tkinter import messagebox
 import re
+import itertools
+import time
+from fnmatch import fnmatch
+from storage_bmdm import open_store, migrate_index, journal_lock, PREFIX_SIZE
+from objects_bmdm import ObjectStore, hash_file
+from history_bmdm import HistoryWriter, read_recent, record_filter
+
+def console_prompt(question: str):
+    """
+    To ask a yes/no question on the console
+    """
+    return input(question).lower() in ('y', "yes")
+
+def extract_metadata(file: str, file_path: str):
+    """
+    To extract metadata(patient_id, study_date, modality, decryption, path)
+    * raises NameError for a text file whose name does not follow the format
+    """
+    # for 'txt" files
+    if file.endswith(".txt"):
+        file = os.path.basename(file)
+        parts = file.replace(".txt", "").split("_")
+        if len(parts) < 4:
+            raise NameError("The file name is incorrect. the correct format is 'PATIENTID_STUDYDATE_MODALITY_DESCRIPTION.txt' ")
+        else:
+            metadata = {
+                "filename": file,
+                "patient_id": parts[0],
+                "study_date": parts[1],
+                "modality": parts[2],
+                "description": parts[3:],
+                "path": file_path,
+                "tags": {}
+            }
+            return metadata
+    # for 'json' files
+    elif file.endswith(".json"):
+        with open(file, 'rb') as f:
+            metadata = json.load(f)
+            metadata["filename"] = os.path.basename(file)
+            metadata["tags"] = {}
+            return metadata
+
+def entry_key(object_hash: str, filename: str):
+    """
+    To get the index key of an admitted file: the full blake2s digest of its content hash and its file name
+    * the same bytes under another name (e.g. a copy) are another entry, the same file admitted again is the same entry
+    """
+    return hashlib.blake2s(f"{object_hash}\0{filename}".encode("utf-8")).hexdigest()
+
+def legacy_key(file: str):
+    """
+    To get the 8 character key an index built before full keys gave a file: blake2s of its name (txt) or of its parsed JSON
+    """
+    if file.endswith(".txt"):
+        text = os.path.basename(file)
+    else:
+        with open(file, 'rb') as f:
+            text = str(json.load(f))
+    return hashlib.blake2s(text.encode('utf-8')).hexdigest()[:8]
+
+def walk_files(root: str, include: list = None, exclude: list = None, max_depth: int = None):
+    """
+    To lazily yield (file path, folder path) of the admittable files under 'root'
+    * 'max_depth' 0 means only the files directly inside 'root', None means no limit
+    * 'include' / 'exclude' are glob patterns matched against the path relative to 'root'
+    """
+    stack = [(root, 0)]
+    while stack:
+        folder, depth = stack.pop()
+        sub_folders = []
+        with os.scandir(folder) as entries:
+            for entry in entries:
+                relative = os.path.relpath(entry.path, root).replace(os.sep, "/")
+                if exclude and any(fnmatch(relative, pattern) for pattern in exclude):
+                    continue
+                if entry.is_dir(follow_symlinks=False):
+                    # the manager's own folder holds json files that are not medical data
+                    if entry.name == ".bmdm":
+                        continue
+                    if max_depth is None or depth < max_depth:
+                        sub_folders.append(entry.path)
+                elif entry.is_file() and entry.name.endswith((".txt", ".json")):
+                    if include and not any(fnmatch(relative, pattern) for pattern in include):
+                        continue
+                    yield entry.path, folder
+        # reversed so sub-folders are visited in the order they were listed
+        stack.extend((sub_folder, depth + 1) for sub_folder in reversed(sub_folders))
+
+def store_file(file: str, file_path: str, objects_dir: str):
+    """
+    To extract the metadata of a file and copy its bytes into the object store, returns the metadata and the entry key
+    * the object hash is kept in "object"
+    """
+    metadata = extract_metadata(file, file_path)
+    metadata["object"] = ObjectStore(objects_dir).put(file)
+    return metadata, entry_key(metadata["object"], metadata["filename"])
+
+def _try_store_file(file: str, file_path: str, objects_dir: str, legacy: bool = False):
+    """
+    Worker-side wrapper of 'store_file' that returns the error instead of raising it, and the legacy key if asked
+    """
+    try:
+        metadata, key = store_file(file, file_path, objects_dir)
+        return metadata, key, legacy_key(file) if legacy else None, None
+    except Exception as e:
+        return None, None, None, str(e)
+
+def write_json(path: str, data):
+    """
+    To replace a JSON file atomically: it is written next to the old one and swapped in, so a crash never leaves it torn
+    """
+    temp_file = f"{path}.tmp"
+    with open(temp_file, "w") as t_f:
+        json.dump(data, t_f)
+    os.replace(temp_file, path)
+
+# a study date in a filter: YYYY, YYYYMM, YYYYMMDD or the ISO forms YYYY-MM, YYYY-MM-DD
+DATE_TOKEN = r"\d{4}(?:\d{2}(?:\d{2})?)?|\d{4}-\d{2}(?:-\d{2})?"
+DATE_RANGE = re.compile(rf"\s*({DATE_TOKEN})?\s*-\s*({DATE_TOKEN})?\s*")
+
+def search_filters(filename=None, patient_id=None, study_date=None, modality=None, tag=None, query=None):
+    """
+    To normalise 'find' filters into a dict: a 'YYYYMMDD-YYYYMMDD' study date is a (start, end) range, either side may be empty
+    * a single ISO date ('2024-03-01', '2024-03') matches by its YYYYMMDD date, whichever way the entries write it
+    * any other study date with a '-' is matched as it is
+    * a 'query' expression (see query_bmdm) is kept with the filters, so a cursor belongs to it as well
+    """
+    if isinstance(study_date, str) and "-" in study_date:
+        if re.fullmatch(DATE_TOKEN, study_date.strip()):
+            day = "".join(c for c in study_date if c.isdigit())
+            study_date = (day, day)
+        elif DATE_RANGE.fullmatch(study_date):
+            start, end = DATE_RANGE.fullmatch(study_date).groups()
+            study_date = (start, end)
+    elif isinstance(study_date, list):
+        # a range sent through the daemon arrives as a list
+        study_date = tuple(study_date)
+    filters = {"filename": filename, "patient_id": patient_id, "study_date": study_date, "modality": modality, "tag": tag}
+    if query:
+        filters["query"] = query
+    return filters
+
+def make_cursor(filters: dict, offset: int):
+    """
+    To make the token that continues a 'find' with these filters at 'offset'
+    """
+    import base64
+    query = hashlib.blake2s(json.dumps(filters, sort_keys=True, default=str).encode()).hexdigest()[:8]
+    return base64.urlsafe_b64encode(json.dumps({"q": query, "o": offset}).encode()).decode().rstrip("=")
+
+def read_cursor(cursor: str, filters: dict):
+    """
+    To get the offset a cursor token stands for, it must have been made for the same filters
+    """
+    import base64
+    try:
+        token = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+        offset = int(token["o"])
+    except (ValueError, KeyError, TypeError):
+        raise RuntimeError("The cursor is invalid.")
+    if token.get("q") != hashlib.blake2s(json.dumps(filters, sort_keys=True, default=str).encode()).hexdigest()[:8]:
+        raise RuntimeError("The cursor belongs to another search.")
+    return offset
 
 class BioMedDataManager:
     """
@@ -13,18 +175,32 @@ class BioMedDataManager:
     * Method 'config': to configure and store user or doctor information
     * Method 'admit': to add medical data
     * Method 'stats': to display a collection of data and statical information under management and observation
-    * Method 'tag': to add or remove description tags for a specific data item
-    * Method 'find': to search between data with a specific filter
+    * Method 'patients': to get the ids of the patients in the index
+    * Method 'tag': to add or remove description tags for a specific data item ('tag_many' for many in one write)
+    * Method 'find': to search between data with a specific filter ('iter_find' to stream the results, 'find_count' to count them)
     * Method 'hist': to display history or logs
-    * Method 'export': to export information
+    * Method 'export': to export information ('export_table' to write the index as a CSV / Parquet table)
     * Method 'remove': to remove information
+    * Method 'gc' / 'repack': to delete orphaned objects / to move objects into pack files
     """
     config_file = ".bmdm/config.json"
     history_file = ".bmdm/history.log"
+    # buffered history writer shared by all managers, created on first use
+    history = None
     def __init__(self):
         self.bmdm_dir = ".bmdm"
         self.index_file = ".bmdm/index.json"
         self.objects_dir = ".bmdm/objects"
+        # admits hold it shared while they write objects and commit them, 'gc' and 'repack' hold it alone ('objects.lock')
+        self.objects_lock_file = ".bmdm/objects"
+        self.manifest_file = ".bmdm/manifest.json"
+        # every admit batch appends its manifest records here, folded into 'manifest.json' once it grows past the limit
+        self.manifest_journal_file = ".bmdm/manifest.journal"
+        self.manifest_journal_limit = 4 * 1024 * 1024
+        self.scan_cache_file = ".bmdm/scan_cache.json"
+        self.table_exports_file = ".bmdm/table_exports.json"
+        # index backend, opened on first use (see 'storage_bmdm')
+        self.store = None
 
     def boot(self):
         """
@@ -69,9 +245,10 @@ class BioMedDataManager:
                 
         self._log_activity('boot', "BOOT", "BMDM initialized")
     
-    def config(self, name: str = None, email: str = None):
+    def config(self, name: str = None, email: str = None, history: dict = None):
         """
         to configure and store user or doctor information
+        * 'history' updates the history log settings: max_bytes (0 = no size limit), daily, compress
         """
         if not os.path.isdir(self.bmdm_dir):
 
@@ -79,7 +256,7 @@ class BioMedDataManager:
 
         # format email --> user@example.com 
         pattern = re.compile(r'^[^@]+@[^@]+\.com$')
-        if not bool(pattern.fullmatch(email)):
+        if email != None and not bool(pattern.fullmatch(email)):
             raise RuntimeError("The email must be in the format 'user@example.com'")
         # To add name and email to config file
         with open(self.config_file, 'r') as conf:
@@ -88,14 +265,25 @@ class BioMedDataManager:
                 config["manager"]["name"] = name
             if email != None:
                 config["manager"]["email"] = email
+            if history:
+                config.setdefault("history", {}).update(history)
             with open(self.config_file, "w") as conf:    
                 json.dump(config, conf)
+        self._history_writer().invalidate()
         
-        self._log_activity('config', "CONFIG_UPDATE", f"Updated config: name={name}, email={email}")
+        self._log_activity('config', "CONFIG_UPDATE", f"Updated config: name={name}, email={email}" + (f", history={history}" if history else ""))
     
-    def admit(self, file_path: str):
+    def admit(self, file_path: str, batch_size: int = 500, workers: int = 1, recursive: bool = False,
+              include: list = None, exclude: list = None, max_depth: int = None, force: bool = False,
+              progress=None, cancel=None):
         """
         To add medical data
+        * for folders, the index is merged and written once per 'batch_size' files
+        * 'workers' > 1 extracts metadata of a folder in a process pool
+        * 'recursive' / 'max_depth' descend into sub-folders, 'include' / 'exclude' are glob patterns on the relative path
+        * files unchanged since their last admit (same size and mtime) are skipped unless 'force' is set
+        * 'progress' is called with (files done, total files) after every batch, 'cancel' is an event that stops
+          the admit after the current batch (the batches already written stay admitted)
         """
         if not os.path.isdir(self.bmdm_dir):
             
@@ -105,306 +293,832 @@ class BioMedDataManager:
             self._log_activity('admit', "PATH_ERROR", "Path does not exist.")
             raise RuntimeError("Path does not exist")
         
-        def extract_metadata(file:str):
-            """
-            To extract metadata(patient_id, study_date, modality, decryption, path)
-            """
-            # for 'txt" files
-            if file.endswith(".txt"):
-                file = os.path.basename(file)
-                parts = file.replace(".txt", "").split("_")
-                if len(parts) < 4:
-                    self._log_activity('admit', "TYPE_ERROR", "The input file type is incorrect.")
-                    raise NameError("The file name is incorrect. the correct format is 'PATIENTID_STUDYDATE_MODALITY_DESCRIPTION.txt' ")
-                else:
-                    metadata = {
-                        "filename": file,
-                        "patient_id": parts[0],
-                        "study_date": parts[1],
-                        "modality": parts[2],
-                        "description": parts[3:],
-                        "path": file_path,
-                        "tags": {}
-                    }
-                    hash = hashlib.blake2s(file.encode('utf-8')).hexdigest()
-                    return metadata, hash
-            # for 'json' files
-            elif file.endswith(".json"):
-                with open(file, 'rb') as f:
-                    metadata = json.load(f)
-                    hash = hashlib.blake2s(str(metadata).encode()).hexdigest()
-                    metadata["filename"] = os.path.basename(file)
-                    metadata["tags"] = {}
-                    return metadata, hash
+        # objects are written before the index refers to them, 'gc' and 'repack' wait until the admit is committed
+        with journal_lock(self.objects_lock_file, shared=True):
+            return self._admit(file_path, batch_size, workers, recursive, include, exclude, max_depth, force, progress, cancel)
+
+    def _admit(self, file_path, batch_size, workers, recursive, include, exclude, max_depth, force, progress, cancel):
+        """
+        The body of 'admit', run while the objects lock is held
+        """
+        # the manifest remembers size, mtime and entry key of admitted files so unchanged ones are skipped
+        manifest = self._load_manifest()
+        store = self._store()
+        # number of admitted paths per entry key, counted by '_stale_keys' once some path's key changes
+        references = None
 
         # if input is file
         if os.path.isfile(file_path):
             if not file_path.endswith((".txt", ".json")):
                 self._log_activity('admit', "FORMAT_ERROR", "The format is invalid.")
                 raise TypeError("The format is invalid.")
-            metadata, hash = extract_metadata(file_path)
-            med_data = {hash[:8]: metadata}
-            with open(self.index_file, 'r') as index:
-                index_data = json.load(index)
-                index_data.update(med_data)
-            with open(self.index_file, "w") as index:
-                json.dump(index_data, index, indent=4)
-            with open(f"{self.objects_dir}/{hash}.data", 'w') as mdate:
-                json.dump(metadata, mdate, indent=4)
+            stat = os.stat(file_path)
+            if not force and self._is_unchanged(manifest.get(os.path.abspath(file_path)), stat, store):
+                self._log_activity('admit', "ADMIT", "The file has not changed since it was admitted.")
+                return
+            try:
+                metadata, key = store_file(file_path, file_path, self.objects_dir)
+            except NameError:
+                self._log_activity('admit', "TYPE_ERROR", "The input file type is incorrect.")
+                raise
+            records = {os.path.abspath(file_path): {"size": stat.st_size, "mtime": stat.st_mtime_ns, "key": key}}
+            # a file admitted before the manifest existed may still be indexed under its legacy key
+            legacy = {} if os.path.abspath(file_path) in manifest else {os.path.abspath(file_path): legacy_key(file_path)}
+            stale, references = self._stale_keys(records, manifest, references, legacy)
+            manifest.update(records)
+            self._commit_batch({key: metadata}, records, stale)
+            if progress:
+                progress(1, 1)
             
             self._log_activity('admit', "ADMIT", "Information was recorded.")
         
         # if input is folder
         elif os.path.isdir(file_path):
-            files = []
-            for f in os.listdir(file_path):
-                if f.endswith((".txt", ".json")):
-                    metadata, hash = extract_metadata(f'{file_path}/{f}')
-                    med_data = {hash[:8]: metadata}
-                    with open(self.index_file, "r") as index:
-                        index_data = json.load(index)
-                    index_data.update(med_data)
-                    with open(self.index_file, "w") as index:
-                        json.dump(index_data, index, indent=4)
-                    with open(f"{self.objects_dir}/{hash}.data", 'w') as mdate:
-                        json.dump(metadata, mdate, indent=4)
-                    files.append(f)
-                
-            if len(files) == 0:
+            if batch_size < 1:
+                raise RuntimeError("The batch size must be at least 1.")
+            if workers < 1:
+                raise RuntimeError("The number of workers must be at least 1.")
+            admitted = 0
+            skipped = 0
+            failed = {}
+            if not recursive and max_depth is None:
+                max_depth = 0
+            # files are pulled lazily from the walker, so only one batch is held in memory at a time
+            files = walk_files(file_path, include, exclude, max_depth)
+            # the total for 'progress' costs one more walk, only the names are listed
+            total = sum(1 for _ in walk_files(file_path, include, exclude, max_depth)) if progress else None
+            done = 0
+            cancelled = False
+            # extraction, hashing and copying into the object store can run in a process pool, the index is only written here
+            executor = None
+            if workers > 1:
+                from concurrent.futures import ProcessPoolExecutor
+                executor = ProcessPoolExecutor(max_workers=workers)
+            try:
+                while True:
+                    if cancel is not None and cancel.is_set():
+                        cancelled = True
+                        break
+                    chunk = list(itertools.islice(files, batch_size))
+                    if not chunk:
+                        break
+                    done += len(chunk)
+                    # only a stat is needed to skip files that have not changed since the last admit
+                    paths, roots, stats = [], [], []
+                    for path, root in chunk:
+                        stat = os.stat(path)
+                        if not force and self._is_unchanged(manifest.get(os.path.abspath(path)), stat, store):
+                            skipped += 1
+                            continue
+                        paths.append(path)
+                        roots.append(root)
+                        stats.append(stat)
+                    if not paths:
+                        if progress:
+                            progress(done, total)
+                        continue
+                    # files the manifest does not know may have been admitted before it existed, under a legacy key
+                    unknown = [os.path.abspath(path) not in manifest for path in paths]
+                    if executor:
+                        results = executor.map(_try_store_file, paths, roots, itertools.repeat(self.objects_dir), unknown, chunksize=max(1, len(paths) // (workers * 4)))
+                    else:
+                        results = map(_try_store_file, paths, roots, itertools.repeat(self.objects_dir), unknown)
+                    # results come back in input order, so the index is written exactly as in a serial run
+                    batch = {}
+                    records = {}
+                    legacy = {}
+                    for path, stat, (metadata, key, old, error) in zip(paths, stats, results):
+                        # a bad file is recorded and reported at the end instead of stopping the whole folder
+                        if error:
+                            failed[os.path.relpath(path, file_path)] = error
+                            continue
+                        batch[key] = metadata
+                        records[os.path.abspath(path)] = {"size": stat.st_size, "mtime": stat.st_mtime_ns, "key": key}
+                        if old:
+                            legacy[os.path.abspath(path)] = old
+                        admitted += 1
+                    if batch:
+                        stale, references = self._stale_keys(records, manifest, references, legacy)
+                        manifest.update(records)
+                        self._commit_batch(batch, records, stale)
+                    if progress:
+                        progress(done, total)
+            finally:
+                if executor:
+                    executor.shutdown()
+
+            if cancelled:
+                self._log_activity('admit', "ADMIT", f"The admit was cancelled after {done} file(s).")
+            elif admitted == 0 and skipped == 0 and len(failed) == 0:
                 self._log_activity('admit', "ADMIT_ERROR", "The specified folder does not contain a file with the correct format.")
                 raise RuntimeError("The specified folder does not contain a file with the correct format.")
 
+            if failed:
+                self._log_activity('admit', "ADMIT_ERROR", f"{len(failed)} file(s) could not be admitted: {', '.join(failed)}")
+            if admitted:
+                self._log_activity('admit', "ADMIT", f"Information was recorded ({admitted} file(s)).")
+            if skipped:
+                self._log_activity('admit', "ADMIT", f"{skipped} unchanged file(s) were skipped.")
+            result = {"admitted": admitted, "skipped": skipped, "failed": failed}
+            if cancelled:
+                result["cancelled"] = True
+            return result
+
+    def _load_manifest(self):
+        """
+        To read the admit manifest {absolute path: {size, mtime, key}}
+        * 'manifest.json' is a snapshot and 'manifest.journal' holds one JSON line per admit batch since, replayed on top
+        * a line torn by a crash is skipped, its files are only hashed again on the next admit
+        """
+        manifest = self._read_manifest()
+        if os.path.isfile(self.manifest_journal_file) and os.path.getsize(self.manifest_journal_file) > self.manifest_journal_limit:
+            with journal_lock(self.manifest_journal_file):
+                # read again under the lock, another admit may have appended in the meantime
+                manifest = self._read_manifest()
+                write_json(self.manifest_file, manifest)
+                open(self.manifest_journal_file, "wb").close()
+        return manifest
+
+    def _read_manifest(self):
+        manifest = {}
+        if os.path.isfile(self.manifest_file):
+            try:
+                with open(self.manifest_file, "r") as m_f:
+                    manifest = json.load(m_f)
+            except ValueError:
+                manifest = {}
+        if os.path.isfile(self.manifest_journal_file):
+            with open(self.manifest_journal_file, "rb") as j_f:
+                for line in j_f:
+                    try:
+                        manifest.update(json.loads(line))
+                    except ValueError:
+                        continue
+        return manifest
+
+    @staticmethod
+    def _is_current(record, stat):
+        """
+        True if a manifest (or scan cache) record still matches the file on disk
+        """
+        return record is not None and record["size"] == stat.st_size and record["mtime"] == stat.st_mtime_ns
+
+    @classmethod
+    def _is_unchanged(cls, record, stat, store):
+        """
+        True if a manifest record still matches the file on disk and its entry is still in the index
+        """
+        return cls._is_current(record, stat) and store.get(cls._manifest_key(record)) is not None
+
+    @staticmethod
+    def _manifest_key(record):
+        """
+        To get the entry key of a manifest record, records written before full keys hold the file "hash" whose first 8 characters were the key
+        """
+        return record["key"] if "key" in record else record["hash"][:8]
+
+    def _stale_keys(self, records: dict, manifest: dict, references: dict = None, legacy: dict = None):
+        """
+        To get the keys that re-admitted paths no longer point at, an entry still admitted from another path is kept
+        * 'records' are the new manifest records of a batch (not yet in 'manifest'), returns (stale keys, references)
+        * 'references' counts the manifest paths per key, None until a key first changes: only then is the whole
+          manifest counted, afterwards the counts are kept up to date here
+        * 'legacy' maps paths without a manifest record to their legacy key, an entry indexed under it is replaced
+        """
+        store = self._store()
+        changed = []
+        for path, record in records.items():
+            if path in manifest:
+                old = self._manifest_key(manifest[path])
+            elif legacy and path in legacy and store.get(legacy[path]) is not None:
+                old = legacy[path]
             else:
-                self._log_activity('admit', "ADMIT", "Information was recorded.")
-                
-    def stats(self):
+                continue
+            if old != record["key"]:
+                changed.append(old)
+        if references is None:
+            if not changed:
+                # admits of new or unchanged files never walk the whole manifest
+                return [], None
+            references = {}
+            for record in manifest.values():
+                key = self._manifest_key(record)
+                references[key] = references.get(key, 0) + 1
+        for path, record in records.items():
+            references[record["key"]] = references.get(record["key"], 0) + 1
+            if path in manifest:
+                references[self._manifest_key(manifest[path])] -= 1
+        return [key for key in dict.fromkeys(changed) if references.get(key, 0) == 0], references
+
+    def _commit_batch(self, batch: dict, records: dict = None, stale: list = ()):
+        """
+        To merge a batch of {key: metadata} into the index in a single commit, the 'stale' keys are removed first
+        * the files themselves are already in the object store, written while their metadata was extracted
+        * the batch's manifest records {absolute path: {size, mtime, key}} are appended to 'manifest.journal' as one line
+        """
+        removals = [{"op": "remove", "key": key} for key in stale]
+        self._store().apply(removals + [{"op": "admit", "key": key, "entry": metadata} for key, metadata in batch.items()])
+        if records:
+            with journal_lock(self.manifest_journal_file):
+                with open(self.manifest_journal_file, "a+b") as j_f:
+                    # a line torn by a crash is ended first, so this batch starts on a line of its own
+                    if j_f.seek(0, os.SEEK_END) > 0:
+                        j_f.seek(-1, os.SEEK_END)
+                        if j_f.read(1) != b"\n":
+                            j_f.write(b"\n")
+                    j_f.write(json.dumps(records).encode() + b"\n")
+
+    def stats(self, path: str = "./", recursive: bool = False, detailed: bool = False):
         """
         to display a collection of data and statical information under management and observation
+        * the totals are kept up to date by every change of the index, so they are not recounted here
+        * 'detailed' gives counts per patient, modality, tag value and study month instead of the short summary
+        * unmanaged files are searched in 'path' (and its sub-folders with 'recursive')
+        * a file is only read when it is not in the admit manifest or scan cache with the same size and mtime
         """
         if not os.path.isdir(self.bmdm_dir):
             
             raise RuntimeError("First you need to load the boot, run 'python bmdm.py boot' first")
         
-        with open(self.index_file, "r") as index:
-            data = json.load(index)
-            total = len(data)
-            unmanaged = []
-            patients = []
-            modalities = []
-            tags = []
-            for i in os.listdir("./"):
-                if i.endswith(".txt"):    
-                    if hashlib.blake2s(i.encode('utf-8')).hexdigest()[:8] not in list(data.keys()):
-                        unmanaged.append(i)
-                elif i.endswith(".json"):
-                    with open(i, "rb") as f:
-                        file = json.load(f) # have problem
-                        if hashlib.blake2s(str(file).encode()).hexdigest()[:8] not in list(data.keys()):
-                            unmanaged.append(i)
-
-            for h in list(data.keys()):
-                patients.append(data[h]['patient_id'])
-                modalities.append(data[h]['modality'])
-                tags.append(str(data[h]['tags']))
-
-            stats = {
-                "total_entries": total,
-                "unmanaged_files": unmanaged,
-                "patients": patients,
-                "modalities": list(set(modalities)),
-                "tags": list(set(tags))
-            }
+        if not os.path.isdir(path):
+            self._log_activity('stats', "PATH_ERROR", "Path does not exist.")
+            raise RuntimeError("Path does not exist")
+        
+        store = self._store()
+        summary = store.aggregates().summary(detailed)
+        stats = {
+            "total_entries": summary.pop("total_entries"),
+            "unmanaged_files": self._unmanaged_files(path, recursive, store),
+            **summary
+        }
 
-            self._log_activity('stats', "STATS", "All data was retrieved.")
-            return stats
-    
-    def tag(self, id_filename:str, key:str, value:str, remove:bool, is_gui=False):
+        self._log_activity('stats', "STATS", "All data was retrieved.")
+        return stats
+
+    def patients(self):
+        """
+        To get the ids of the patients in the index
+        """
+        if not os.path.isdir(self.bmdm_dir):
+            
+            raise RuntimeError("First you need to load the boot, run 'python bmdm.py boot' first")
+        
+        return sorted(self._store().aggregates().data["patients"])
+
+    def _unmanaged_files(self, path: str, recursive: bool, store):
+        """
+        To list the admittable files under 'path' whose entry is not in the index
+        * each candidate is looked up on its own, the index keys are never all loaded
+        * keys come from the admit manifest or '.bmdm/scan_cache.json' {absolute path: {size, mtime, key}} while the file is unchanged
+        """
+        manifest = self._load_manifest()
+        cache = {}
+        if os.path.isfile(self.scan_cache_file):
+            try:
+                with open(self.scan_cache_file, "r") as c_f:
+                    cache = json.load(c_f)
+            except ValueError:
+                # the cache can always be rebuilt, a damaged one is just dropped
+                cache = {}
+        changed = False
+        unmanaged = []
+        seen = set()
+        folders = set()
+        for file, folder in walk_files(path, max_depth=None if recursive else 0):
+            absolute = os.path.abspath(file)
+            seen.add(absolute)
+            folders.add(os.path.abspath(folder))
+            stat = os.stat(file)
+            record = manifest.get(absolute)
+            if self._is_current(record, stat):
+                key = self._manifest_key(record)
+            else:
+                record = cache.get(absolute)
+                # records cached before full keys have no "key" (or "legacy") and are made again
+                if not (self._is_current(record, stat) and "legacy" in record):
+                    try:
+                        key = entry_key(hash_file(file), extract_metadata(file, folder)["filename"])
+                        legacy = legacy_key(file)
+                    except Exception:
+                        # a file that can not be admitted is never managed
+                        key = legacy = None
+                    record = {"size": stat.st_size, "mtime": stat.st_mtime_ns, "key": key, "legacy": legacy}
+                    cache[absolute] = record
+                    changed = True
+                key = record["key"]
+            # a file admitted before the manifest existed is still managed under its legacy key
+            legacy = record.get("legacy")
+            if key is None or (store.get(key) is None and (legacy is None or store.get(legacy) is None)):
+                unmanaged.append(os.path.relpath(file, path).replace(os.sep, "/"))
+        # files deleted from the scanned folders are dropped from the cache
+        for absolute in [a for a in cache if os.path.dirname(a) in folders and a not in seen]:
+            del cache[absolute]
+            changed = True
+        if changed:
+            write_json(self.scan_cache_file, cache)
+        return unmanaged
+
+    def tag(self, id_filename:str, key:str, value:str, remove:bool, overwrite:bool=None, prompt=None):
         """
         to add or remove description tags for a specific data item
+        * a patient id or filename with several entries changes every one of them
+        * 'overwrite' decides what happens to an existing key, None asks the user
+        * 'prompt' is a callable(question) -> bool used to ask, the console is used by default
+        """
+        if not os.path.isdir(self.bmdm_dir):
+            
+            raise RuntimeError("First you need to load the boot, run 'python bmdm.py boot' first")
+        
+        store = self._store()
+        # a patient id with several entries tags all of them
+        targets = self._find_tag_targets(id_filename)
+        if not targets:
+            self._log_activity('tag', "TAG_ERROR", f"The {id_filename} not found.")
+            raise RuntimeError("The entered 'ID' or 'filename' does not exist.")
+        hashes = [entry_hash for entry_hash, _ in targets]
+        existing = [entry_hash for entry_hash, entry in targets if key in entry["tags"]]
+        if remove:
+            if not existing:
+                self._log_activity('tag', "TAG_ERROR", "The entered key does not exist in tags list.")
+                raise RuntimeError("The entered key does not exist.")
+            store.apply([{"op": "untag", "key": entry_hash, "tag": key} for entry_hash in existing])
+            self._log_activity('tag', "REMOVE_TAG", f"Tag with key {key} was removed from data {id_filename}.", [id_filename, *existing])
+        else:
+            if existing and overwrite is None:
+                # the question goes through 'prompt' so the GUI (or any other caller) can ask it its own way
+                overwrite = (prompt or console_prompt)("A tag with this key already exists.\nAre you sure you want to change it(yes,no)? ")
+            # without 'overwrite' the entries that already have the key are left as they are
+            tagged = hashes if overwrite else [entry_hash for entry_hash in hashes if entry_hash not in existing]
+            if not tagged:
+                if prompt is None:
+                    print('No changes were made.')
+                self._log_activity('tag', "ADD_TAG", "Not new tags have been added")
+                return
+            store.apply([{"op": "tag", "key": entry_hash, "tag": key, "value": value} for entry_hash in tagged])
+            self._log_activity('tag', "ADD_TAG", f"The data '{id_filename}' was tagged with the value '{key}={value}'.", [id_filename, *tagged])
+
+    def tag_many(self, operations: list, on_conflict: str = "fail"):
+        """
+        To add or remove many tags in one index write, returns the number of tags added, removed, skipped and entries not found
+        * every operation is a dict: "id" (patient id or filename, all of its entries) or "hash", "key", "value" and "remove" (default False)
+        * 'on_conflict' decides what happens to an existing key with another value, a missing key to remove or a missing entry:
+          "overwrite" changes the value (and skips the rest), "skip" leaves it, "fail" stops before anything is written
         """
         if not os.path.isdir(self.bmdm_dir):
             
             raise RuntimeError("First you need to load the boot, run 'python bmdm.py boot' first")
         
-        with open(self.index_file, "r") as index:
-            index_file = json.load(index)
-            hashs = tuple(index_file.keys())
-            id_s = [index_file[i]["patient_id"] for i in hashs]
-            name_s = [index_file[i]["filename"] for i in hashs]
-            if id_filename in id_s:
-                tags = list(index_file[hashs[id_s.index(id_filename)]]["tags"])
-            if id_filename in name_s:
-                tags = list(index_file[hashs[name_s.index(id_filename)]]["tags"])
-            if id_filename not in id_s and id_filename not in name_s:
-                self._log_activity('tag', "TAG_ERROR", f"The {id_filename} not found.")
-                raise RuntimeError("The entered 'ID' or 'filename' does not exist.")
-            elif remove:
-                if key not in tags:
-                    self._log_activity('tag', "TAG_ERROR", "The entered key does not exist in tags list.")
-                    raise RuntimeError("The entered key does not exist.")
+        if on_conflict not in ("overwrite", "skip", "fail"):
+            raise RuntimeError("The conflict policy must be 'overwrite', 'skip' or 'fail'.")
+        store = self._store()
+        targets = {}
+        # the tags each touched entry will have, so later operations see the earlier ones
+        pending = {}
+        records = []
+        # the ids (or hashes) of the operations that changed something, in order: {name: named by hash}
+        touched = {}
+        summary = {"tagged": 0, "untagged": 0, "skipped": 0, "missing": 0}
+        for number, operation in enumerate(operations, 1):
+            name = operation.get("hash") or operation.get("id")
+            if not name or not operation.get("key"):
+                raise RuntimeError(f"Operation {number} needs an 'id' (or 'hash') and a 'key'.")
+            if name not in targets:
+                if operation.get("hash"):
+                    entry = store.get(name)
+                    targets[name] = [] if entry is None else [(name, entry)]
                 else:
-                    if id_filename in id_s:
-                        del index_file[hashs[id_s.index(id_filename)]]["tags"][key]
-                    elif id_filename in name_s:
-                        del index_file[hashs[name_s.index(id_filename)]]["tags"][key]
-                    with open(self.index_file, "w") as index:    
-                        json.dump(index_file, index, indent=4)
-                    self._log_activity('tag', "REMOVE_TAG", f"Tag with key {key} was removed from data {id_filename}.")
-            else:
-                if id_filename in id_s:
-                    if key not in list(index_file[hashs[id_s.index(id_filename)]]["tags"].keys()):
-                        index_file[hashs[id_s.index(id_filename)]]["tags"][key] = value
-                    else:
-                        if not is_gui:    
-                            if input("A tag with this key already exists.\nAre you sure you want to change it(yes,no)? ").lower() in ('y', "yes"):
-                                index_file[hashs[id_s.index(id_filename)]]["tags"][key] = value
-                            else:
-                                print('No changes were made.')
-                                self._log_activity('tag', "ADD_TAG", "Not new tags have been added")
-                                return
-                        else:
-                            answer = messagebox.askyesno('تگ تکراری', "A tag with this key already exists.\nAre you sure you want to change it?")
-                            if answer:
-                                index_file[hashs[id_s.index(id_filename)]]["tags"][key] = value
-                            else:
-                                messagebox.showwarning('تگ تکراری', 'No changes were made.')
-                                self._log_activity('tag', "ADD_TAG", "Not new tags have been added")
-                    with open(self.index_file, "w") as index:    
-                        json.dump(index_file, index, indent=4)
-                elif id_filename in name_s:
-                    if key not in list(index_file[hashs[name_s.index(id_filename)]]["tags"].keys()):    
-                        index_file[hashs[name_s.index(id_filename)]]["tags"][key] = value
-                    else:
-                        if input("A tag with this key already exists.\nAre you sure you want to change it(yes,no)? ").lower() in ('y', "yes"):
-                            index_file[hashs[name_s.index(id_filename)]]["tags"][key] = value
-                        else:
-                            print('No changes were made.')
-                            self._log_activity('tag', "ADD_TAG", "Not new tags have been added")
-                            return
-                    with open(self.index_file, "w") as index:    
-                        json.dump(index_file, index, indent=4)
-                self._log_activity('tag', "ADD_TAG", f"The data '{id_filename}' was tagged with the value '{key}={value}'.")
-    
-    def find(self, filename=None, patient_id=None, study_date=None, modality=None, tag=None):
+                    # a patient id with several entries applies the operation to all of them
+                    targets[name] = self._find_tag_targets(name)
+            if not targets[name]:
+                if on_conflict == "fail":
+                    raise RuntimeError(f"Operation {number}: '{name}' does not exist, no tags were changed.")
+                summary["missing"] += 1
+                continue
+            key = operation["key"]
+            for entry_hash, entry in targets[name]:
+                tags = pending.setdefault(entry_hash, dict(entry.get("tags", {})))
+                if operation.get("remove"):
+                    if key not in tags:
+                        if on_conflict == "fail":
+                            raise RuntimeError(f"Operation {number}: '{name}' ({entry_hash}) has no tag '{key}', no tags were changed.")
+                        summary["skipped"] += 1
+                        continue
+                    del tags[key]
+                    records.append({"op": "untag", "key": entry_hash, "tag": key})
+                    touched[name] = bool(operation.get("hash"))
+                    summary["untagged"] += 1
+                else:
+                    value = operation.get("value")
+                    if key in tags and tags[key] == value:
+                        summary["skipped"] += 1
+                        continue
+                    if key in tags and on_conflict != "overwrite":
+                        if on_conflict == "fail":
+                            raise RuntimeError(f"Operation {number}: '{name}' ({entry_hash}) already has '{key}={tags[key]}', no tags were changed.")
+                        summary["skipped"] += 1
+                        continue
+                    tags[key] = value
+                    records.append({"op": "tag", "key": entry_hash, "tag": key, "value": value})
+                    touched[name] = bool(operation.get("hash"))
+                    summary["tagged"] += 1
+        if records:
+            # one write for the whole batch, however many entries it touches
+            store.apply(records)
+        changed = list(dict.fromkeys(record["key"] for record in records))
+        # the ids the operations named are logged with the hashes, so 'hist --target <patient id>' finds the change
+        # (text history lines have no target list, there the ids are part of the details)
+        ids = [name for name, by_hash in touched.items() if not by_hash]
+        named = f" Changed: {', '.join(ids)}." if ids else ""
+        self._log_activity('tag', "BULK_TAG", f"{summary['tagged']} tags were added and {summary['untagged']} removed on {len(changed)} entries ({summary['skipped']} skipped, {summary['missing']} not found, on conflict: {on_conflict}).{named}", list(dict.fromkeys([*touched, *changed])))
+        return summary
+
+    def _find_tag_targets(self, id_filename:str):
+        """
+        To get the [(hash, entry), ..] a tag applies to: an entry hash, every entry of a patient id or of a filename
+        """
+        store = self._store()
+        return [(entry_hash, store.get(entry_hash)) for entry_hash in self._resolve([id_filename])[id_filename]]
+
+    def _resolve(self, ids: list):
+        """
+        To map every id to the hashes of its entries: {id: [hash, ..]}, an empty list when nothing matches
+        * an id is an entry hash, a patient id (all of the patient's entries) or a filename
+        * an id matching none of them may also be the start of one hash (at least PREFIX_SIZE characters)
+        * every id is looked up through the store's key and field indexes, the index is never scanned
+        """
+        store = self._store()
+        resolved = {}
+        for id in ids:
+            if id in resolved:
+                continue
+            if store.get(id) is not None:
+                resolved[id] = [id]
+                continue
+            matches = store.query(patient_id=id) + store.query(filename=id)
+            resolved[id] = list(dict.fromkeys(key for key, _ in matches))
+            if not resolved[id] and len(id) >= PREFIX_SIZE:
+                keys = store.with_prefix(id)
+                if len(keys) > 1:
+                    raise RuntimeError(f"The hash '{id}' is ambiguous, it starts {len(keys)} entries: {', '.join(keys)}.")
+                resolved[id] = keys
+        return resolved
+
+    def find(self, filename=None, patient_id=None, study_date=None, modality=None, tag=None, query: str = None):
         """
         to search between data with a specific filter
+        * 'study_date' can be a date, a 'start-end' string or a (start, end) tuple, ranges are returned in date order
+        * 'query' is an expression like "modality in (CT,MR) and tag:site=lung and not patient_id~^TEST" (see query_bmdm)
+        """
+        return list(self.iter_find(filename, patient_id, study_date, modality, tag, query=query))
+
+    def iter_find(self, filename=None, patient_id=None, study_date=None, modality=None, tag=None,
+                  offset: int = 0, limit: int = None, fields: list = None, cursor: str = None, query: str = None):
+        """
+        To stream the results of 'find' one entry at a time
+        * 'offset' / 'limit' select a page, a 'cursor' (see 'make_cursor') continues where an earlier page stopped
+        * 'fields' keeps only these fields of every entry, "hash" is the entry's index key
+        * 'query' narrows the filters down further, they must both match
         """
         if not os.path.isdir(self.bmdm_dir):
             
             raise RuntimeError("First you need to load the boot, run 'python bmdm.py boot' first")
         
-        with open(self.index_file, "r") as index:
-            index_file = json.load(index)
-            # filename_s = [i["filename"] for i in {index_file.values()}]
-            # id_s = [i["patient_id"] for i in {index_file.values()}]
-            # study_date_s = [i["study_data"] for i in {index_file.values()}]
-            # modality_s = [i["modality"] for i in {index_file.values()}]
-            # tags_s = [i["tags"] for i in {index_file.values()}]
+        filters = search_filters(filename, patient_id, study_date, modality, tag, query)
+        study_date = filters["study_date"]
+        if cursor:
+            offset = read_cursor(cursor, filters)
+        if offset < 0 or (limit is not None and limit < 0):
+            raise RuntimeError("The offset and the limit can not be negative.")
+        matches, _ = self._query_matches(filters)
+        self._log_activity('find', "SEARCH", f"Searched with criteria: filename='{filename}', patient_id='{patient_id}', modality='{modality}', date='{study_date}', tag='{tag}'" + (f", query='{query}'" if query else ""))
+        # the store yields lazily, so nothing past the requested page is read
+        page = itertools.islice(matches, offset, None if limit is None else offset + limit)
+        if not fields:
+            # entries are handed out as plain dicts, whatever the backend keeps them as
+            return (dict(entry) for _, entry in page)
+        return ({field: key if field == "hash" else entry.get(field) for field in fields} for key, entry in page)
+
+    def find_count(self, filename=None, patient_id=None, study_date=None, modality=None, tag=None, query: str = None):
+        """
+        To count the results of 'find' without reading the entries
+        * with a 'query' the entries are only read when the index lookups alone can not decide it
+        """
+        if not os.path.isdir(self.bmdm_dir):
+            
+            raise RuntimeError("First you need to load the boot, run 'python bmdm.py boot' first")
         
-            results = []
-
-            for entry in index_file:
-                match = True
-                if filename and index_file[entry]["filename"] != filename:
-                    match = False
-                if patient_id and index_file[entry]["patient_id"] != patient_id:
-                    match = False
-                if study_date and index_file[entry]["study_date"] != study_date:
-                    match = False
-                if modality and index_file[entry]["modality"] != modality:
-                    match = False
-                if tag:
-                    key, value = tag.split('=')
-                    if key not in index_file[entry]['tags'].keys() or index_file[entry]['tags'][key] != value:
-                        match = False
-                
-                if match:
-                    results.append(index_file[entry])
-        self._log_activity('find', "SEARCH", f"Searched with criteria: filename='{filename}', patient_id='{patient_id}', modality='{modality}', date='{study_date}', tag='{tag}'")
-        return results
+        filters = search_filters(filename, patient_id, study_date, modality, tag, query)
+        study_date = filters["study_date"]
+        matches, lookups = self._query_matches(filters)
+        if lookups is None:
+            total = sum(1 for _ in matches)
+        else:
+            # disjoint lookups: the store counts each one from its index
+            store = self._store()
+            total = sum(store.count(**lookup) for lookup in lookups)
+        self._log_activity('find', "SEARCH", f"Counted {total} entries with criteria: filename='{filename}', patient_id='{patient_id}', modality='{modality}', date='{study_date}', tag='{tag}'" + (f", query='{query}'" if query else ""))
+        return total
+
+    def _query_matches(self, filters: dict):
+        """
+        To get the (key, entry) pairs matching normalised 'find' filters and the lookups that count them exactly
+        * the lookups are None when the entries have to be checked one by one against the query
+        """
+        store = self._store()
+        filters = dict(filters)
+        query = filters.pop("query", None)
+        if not query:
+            return store.iter_query(**filters), [filters]
+        from query_bmdm import parse_query
+        plan = parse_query(query)
+        given = {field: value for field, value in filters.items() if value is not None}
+        # the explicit filters win over what the query plan picked for the same field
+        lookups = list({tuple(sorted(dict(lookup, **given).items())): dict(lookup, **given) for lookup in plan.lookups}.values())
+        exact = plan.exact and not any(field in lookup for lookup in plan.lookups for field in given)
+        candidates = itertools.chain.from_iterable(store.iter_query(**lookup) for lookup in lookups)
+        return ((key, entry) for key, entry in candidates if plan.matches(key, entry)), lookups if exact else None
+
     @classmethod
-    def _log_activity(cls, method, activity_type, details):
-        """Log an activity to history file"""
-        with open(cls.history_file, 'a') as f:
-            timestamp = datetime.now().isoformat()
+    def _log_activity(cls, method, activity_type, details, targets=None):
+        """Log an activity to history file, 'targets' are the ids / hashes it touched"""
+        cls._history_writer().write(method, activity_type, details, targets)
 
-            with open(cls.config_file, "r") as c_f:
-                config_file = json.load(c_f)
-                
-                user = str(config_file).replace('{', '').replace('}', '').replace("'manager':", '')
-            
-            f.write(f"{timestamp}|command: {method}|{activity_type}: {details}|{user}\n")
+    @classmethod
+    def _history_writer(cls):
+        """
+        To get the shared buffered writer of the history file (see 'history_bmdm')
+        """
+        if cls.history is None:
+            cls.history = HistoryWriter(cls.history_file, cls.config_file)
+        return cls.history
 
-    def hist(self, number:int):
+    def hist(self, number:int, since:str=None, until:str=None, command:str=None, activity:str=None, user:str=None, target:str=None):
         """
         To display history or logs
+        * 'since' / 'until' limit the history to a time window (ISO timestamps or prefixes such as '2024-05')
+        * 'command', 'activity', 'user' (name or email) and 'target' (id, filename or hash) keep only matching records
         """
         if not os.path.isdir(self.bmdm_dir):
             
             raise RuntimeError("First you need to load the boot, run 'python bmdm.py boot' first")
-        with open(self.history_file, 'r') as h_f:    
-            lines = h_f.readlines()
-            lines.reverse()
-            #
-            if number == 'all':
-                number = len(lines)
-            hist = []
-            for l in lines[:number]:
-                print(f'{l}', end="")
-                hist.append(l)
+        # records still in the buffer are part of the history too
+        self._history_writer().flush()
+        # the log is read backwards from its end, so only the requested lines are read
+        where = record_filter(command, activity, user, target)
+        hist = read_recent(self.history_file, None if number == 'all' else number, since, until, where)
+        if number == 'all':
+            number = len(hist)
+        for l in hist:
+            print(f'{l}', end="")
         
         self._log_activity('hist', "HIST", f"Show {number} recently performed activities")
         return hist
     
-    def export(self, id, path):
+    def export(self, id, path, query: str = None, workers: int = 1, progress=None, cancel=None):
         """
-        To export information
+        To export information, returns the number of entries and bytes written and the throughput
+        * 'id' is a patient id, filename or entry hash, or a list of them, every entry of a patient is exported
+        * 'query' (see 'find') exports every matching entry as well, 'id' may then be empty
+        * 'path' is a folder (one JSON file per entry, written by 'workers' threads) or a '.zip', '.tar.gz' or '.jsonl'
+          archive that the entries are streamed into
+        * 'progress' is called with (entries done, total or None) every 100 entries, 'cancel' is an event that stops
+          the export (what was written so far is kept)
         """
         if not os.path.isdir(self.bmdm_dir):
             
             raise RuntimeError("First you need to load the boot, run 'python bmdm.py boot' first")
         
-        if not os.path.exists(path):
+        from export_bmdm import ARCHIVE_SUFFIXES, open_export, export_items
+        archive = path.endswith(ARCHIVE_SUFFIXES)
+        if archive and not os.path.isdir(os.path.dirname(os.path.abspath(path))):
+            self._log_activity('export', "EXPORT_ERROR", "Target directory does not exist.")
+            raise RuntimeError("Target directory does not exist.")
+        if not archive and not os.path.exists(path):
             self._log_activity('export', "EXPORT_ERROR", "Target directory does not exist.")
             raise RuntimeError("Target directory does not exist.")
+        if not archive and os.path.isfile(path):
+            self._log_activity('export', "EXPORT_ERROR", f"{os.path.basename(path)} is file and can not write to it your information.")
+            raise RuntimeError(f"{os.path.basename(path)} is file and can not write to it your information. you should just enter the folder path.")
         
-        files = self.find(patient_id=id)
-        if not files:
+        ids = [] if not id else [id] if isinstance(id, str) else list(id)
+        if not ids and not query:
+            raise RuntimeError("Enter the IDs or a query of the entries to export.")
+        resolved = self._resolve(ids)
+        missing = [id for id, hashes in resolved.items() if not hashes]
+        if missing:
             # if id file not exist    
-            self._log_activity('export', "EXPORT_ERROR", "ID not found.")
-            raise RuntimeError("ID not found.")
-        for entry in files:
-            if os.path.isfile(path):
-                self._log_activity('export', "EXPORT_ERROR", f"{os.path.basename(path)} is file and can not write to it your information.")
-                raise RuntimeError(f"{os.path.basename(path)} is file and can not write to it your information. you should just enter the folder path.")
-            else:
-                with open(rf"{path}\{entry['filename']}", "w") as export_file:
-                    json.dump(entry, export_file, indent=4)
-            self._log_activity('export', "EXPORT", f"Extracted successfully in the file {path}/{entry['filename']} done.")
+            self._log_activity('export', "EXPORT_ERROR", f"ID not found: {', '.join(missing)}.")
+            raise RuntimeError(f"ID not found: {', '.join(missing)}.")
+        store = self._store()
+        hashes = list(dict.fromkeys(hash for hashes in resolved.values() for hash in hashes))
+        entries = ((hash, store.get(hash)) for hash in hashes)
+        total = len(hashes)
+        if query:
+            matches, lookups = self._query_matches(search_filters(query=query))
+            listed = set(hashes)
+            entries = itertools.chain(entries, ((key, entry) for key, entry in matches if key not in listed))
+            # only counted from the index, an entry both listed and matched makes it an upper bound
+            total = None if lookups is None else total + sum(store.count(**lookup) for lookup in lookups)
+        totals = {"exported": 0, "bytes": 0}
+        def counted(items):
+            for name, data in items:
+                if cancel is not None and cancel.is_set():
+                    totals["cancelled"] = True
+                    return
+                totals["exported"] += 1
+                totals["bytes"] += len(data)
+                if progress and totals["exported"] % 100 == 0:
+                    progress(totals["exported"], total)
+                yield name, data
+        start = time.perf_counter()
+        writer = open_export(path, workers)
+        try:
+            # entries are read, encoded and written one batch at a time, the cohort is never held in memory
+            writer.write_all(counted(export_items(entries, jsonl=path.endswith(".jsonl"))))
+        finally:
+            writer.close()
+        if progress:
+            progress(totals["exported"], total)
+        seconds = time.perf_counter() - start
+        totals["seconds"] = round(seconds, 3)
+        totals["entries_per_second"] = round(totals["exported"] / seconds) if seconds else totals["exported"]
+        totals["mb_per_second"] = round(totals["bytes"] / 1024 / 1024 / seconds, 2) if seconds else 0
+        self._log_activity('export', "EXPORT", f"{totals['exported']} entries ({totals['bytes']} bytes) were extracted successfully in {path} in {totals['seconds']} s" + (", then it was cancelled." if totals.get("cancelled") else "."), ids + hashes)
+        return totals
+
+    def export_table(self, path: str, chunk_size: int = 10000, incremental: bool = False):
+        """
+        To write the whole index as one table for analytics: CSV, or Parquet / Arrow (by the file ending, needs pyarrow)
+        * one row per entry, the tags are expanded into 'tag:<key>' columns and the description is joined back into text
+        * rows are written 'chunk_size' at a time, so only one chunk of rows is in memory
+        * 'incremental' appends only the entries added or changed since the last export to the same CSV file,
+          and a row with 'removed' set for each entry removed since then (a changed header means a full export)
+        """
+        if not os.path.isdir(self.bmdm_dir):
+            
+            raise RuntimeError("First you need to load the boot, run 'python bmdm.py boot' first")
+        
+        if chunk_size < 1:
+            raise RuntimeError("The chunk size must be at least 1.")
+        from export_bmdm import table_columns, table_row, entry_fingerprint, open_table
+        start = time.perf_counter()
+        store = self._store()
+        # what every earlier export wrote, so the next one can be incremental
+        exports = {}
+        if os.path.isfile(self.table_exports_file):
+            with open(self.table_exports_file, "r") as e_f:
+                exports = json.load(e_f)
+        target = os.path.abspath(path)
+        columns = table_columns(store.items(), store.aggregates().data["tags"])
+        previous = exports.get(target) if incremental and os.path.isfile(path) else None
+        if previous is not None and previous["columns"] != columns:
+            previous = None
+        writer = open_table(path, columns, append=previous is not None)
+        fingerprints = {}
+        written = removed = 0
+        rows = []
+        try:
+            for key, entry in store.items():
+                fingerprints[key] = entry_fingerprint(entry)
+                if previous is not None and previous["entries"].get(key) == fingerprints[key]:
+                    continue
+                rows.append(table_row(key, entry, columns))
+                if len(rows) >= chunk_size:
+                    writer.write_rows(rows)
+                    written += len(rows)
+                    rows = []
+            if previous is not None:
+                for key in previous["entries"]:
+                    if key not in fingerprints:
+                        rows.append([key] + [""] * (len(columns) - 2) + ["True"])
+                        removed += 1
+            if rows:
+                writer.write_rows(rows)
+                written += len(rows)
+        finally:
+            writer.close()
+        exports[target] = {"columns": columns, "entries": fingerprints}
+        write_json(self.table_exports_file, exports)
+        result = {"mode": "incremental" if previous is not None else "full", "rows": written, "removed": removed,
+                  "columns": len(columns), "seconds": round(time.perf_counter() - start, 3)}
+        self._log_activity('export_table', "EXPORT_TABLE", f"{written} rows ({result['mode']}, {removed} removed) were written to {path}.")
+        return result
 
-                
     def remove(self, id_filename):
         """
         To remove information
+        * 'id_filename' is a patient id, filename or entry hash, or a list of them, every entry of a patient is removed
+        * all entries are removed in one index write, nothing is removed if an id is not found
         """
         if not os.path.isdir(self.bmdm_dir):
             
             raise RuntimeError("First you need to load the boot, run 'python bmdm.py boot' first")
         
-        with open(self.index_file, 'r') as i_f:
-            index_file = json.load(i_f)
-            hashs = list(index_file.keys())
-            for h, key in enumerate(index_file):
-                entry = index_file[key]
-                if entry["filename"] == id_filename or entry["patient_id"] == id_filename:
-                    del index_file[hashs[h]]
-                    self._log_activity('remove', "REMOVE", f"{id_filename} was removed.")
-                    with open(self.index_file, "w") as i_f:
-                        json.dump(index_file, i_f, indent=4)
-                    return
-                else:
-                    self._log_activity('remove', "REMOVE_ERROR", f"{id_filename} not found.")
-                    raise RuntimeError(f"{id_filename} not found.")
+        ids = [id_filename] if isinstance(id_filename, str) else list(id_filename)
+        store = self._store()
+        resolved = self._resolve(ids)
+        missing = [id for id, hashes in resolved.items() if not hashes]
+        if missing:
+            if not store.count():
+                self._log_activity('remove', "REMOVE_ERROR", "The index file is empty.")
+                raise RuntimeError('The index file is empty.')
+            self._log_activity('remove', "REMOVE_ERROR", f"{', '.join(missing)} not found.")
+            raise RuntimeError(f"{', '.join(missing)} not found.")
+        hashes = list(dict.fromkeys(hash for hashes in resolved.values() for hash in hashes))
+        store.apply([{"op": "remove", "key": hash} for hash in hashes])
+        self._log_activity('remove', "REMOVE", f"{', '.join(resolved)} was removed ({len(hashes)} entries).", ids + hashes)
+        return {"removed": len(hashes)}
+
+    def compact(self):
+        """
+        To fold the index journal into a fresh snapshot (or rebuild the SQLite database)
+        """
+        if not os.path.isdir(self.bmdm_dir):
+            
+            raise RuntimeError("First you need to load the boot, run 'python bmdm.py boot' first")
+
+        total = self._store().compact()
+        self._log_activity('compact', "COMPACT", f"The index was compacted ({total} entries).")
+
+    def migrate(self, to: str = "sqlite"):
+        """
+        To convert the index into another backend: 'sqlite' or 'compact' (memory-mapped index.bin)
+        """
+        if not os.path.isdir(self.bmdm_dir):
             
-            self._log_activity('remove', "REMOVE_ERROR", "The index file is empty.")
-            raise RuntimeError('The index file is empty.')
\ No newline at end of file
+            raise RuntimeError("First you need to load the boot, run 'python bmdm.py boot' first")
+
+        source = self._store().name
+        if source == to:
+            self._log_activity('migrate', "MIGRATE_ERROR", f"The index is already stored as {to}.")
+            raise RuntimeError(f"The index is already stored as {to}.")
+        if hasattr(self.store, "close"):
+            self.store.close()
+        total = migrate_index(self.bmdm_dir, to)
+        # the next call opens the new backend
+        self.store = None
+        self._log_activity('migrate', "MIGRATE", f"{total} entries were migrated from {source} to {to}.")
+        return {"backend": to, "entries": total}
+
+    def gc(self):
+        """
+        To delete stored objects that no entry refers to any more (e.g. after 'remove')
+        """
+        if not os.path.isdir(self.bmdm_dir):
+            
+            raise RuntimeError("First you need to load the boot, run 'python bmdm.py boot' first")
+
+        # no admit may be between writing its objects and committing its entries
+        with journal_lock(self.objects_lock_file):
+            keys, keep = self._referenced_objects()
+            objects = ObjectStore(self.objects_dir)
+            try:
+                removed = objects.gc(keep)
+            finally:
+                objects.close()
+            # metadata copies written by older versions ('objects/<hash>.data') are dropped with their entry
+            for name in os.listdir(self.objects_dir):
+                if name.endswith(".data") and name[:8] not in keys:
+                    os.remove(os.path.join(self.objects_dir, name))
+                    removed += 1
+        self._log_activity('gc', "GC", f"{removed} orphaned object(s) were deleted.")
+        return {"removed": removed}
+
+    def repack(self):
+        """
+        To move the loose objects into pack files, orphaned objects are deleted on the way
+        """
+        if not os.path.isdir(self.bmdm_dir):
+            
+            raise RuntimeError("First you need to load the boot, run 'python bmdm.py boot' first")
+
+        # no admit may be between writing its objects and committing its entries
+        with journal_lock(self.objects_lock_file):
+            _, keep = self._referenced_objects()
+            objects = ObjectStore(self.objects_dir)
+            try:
+                packed, removed = objects.repack(keep)
+            finally:
+                objects.close()
+        self._log_activity('repack', "REPACK", f"{packed} object(s) are packed, {removed} orphaned object(s) were deleted.")
+        return {"packed": packed, "removed": removed}
+
+    def _referenced_objects(self):
+        """
+        To get the index keys and the set of object hashes the entries refer to
+        """
+        keys = set()
+        keep = set()
+        for key, entry in self._store().items():
+            keys.add(key)
+            if entry.get("object"):
+                keep.add(entry["object"])
+        return keys, keep
+
+    def _store(self):
+        """
+        To get the index backend of this session
+        """
+        if self.store is None:
+            self.store = open_store(self.bmdm_dir)
+        return self.store
@@ -6,6 +6,9 @@ from tkinter import filedialog
 from tkinter import messagebox
 import os
 import json
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 class GUI_BioMedDataManager():
     '''
@@ -23,6 +26,13 @@ class GUI_BioMedDataManager():
         self.window.iconbitmap(r"D:\university\calss programing\project_pargar\BMDM\icon\logo_bmdm.ico")
         self.main_frame = tk.Frame(window)
         self.bmdm = BioMedDataManager()
+        # the window never waits for history writes, they are flushed in the background
+        self.bmdm._history_writer().start_flusher()
+        # backend calls run one at a time on a worker thread (the index is only ever opened there),
+        # their results come back through a queue that the Tk loop polls
+        self.worker = ThreadPoolExecutor(max_workers=1, thread_name_prefix='bmdm-gui')
+        self.results = queue.Queue()
+        self.window.after(50, self._poll)
         self.window.title('Biomedical data manager')
         self.window.geometry('640x400')
         self.window.resizable(False, False)
@@ -151,6 +161,76 @@ class GUI_BioMedDataManager():
         if email.get():
             email_entry.config(state='readonly', bg='lightgrey')
 
+    def _run(self, function, *args, on_done=None, on_error=None, method='UNKNOWN', **kwargs):
+        '''To call a backend function on the worker thread, 'on_done' (or 'on_error') then gets its result on the Tk thread'''
+        def task():
+            try:
+                result = function(*args, **kwargs)
+            except Exception as e:
+                self.results.put((on_error or (lambda error: self._show_error(error, method)), e))
+            else:
+                if on_done:
+                    self.results.put((on_done, result))
+        self.worker.submit(task)
+
+    def _poll(self):
+        '''To run the callbacks queued by the worker thread, on the Tk thread'''
+        try:
+            while True:
+                try:
+                    callback, value = self.results.get_nowait()
+                except queue.Empty:
+                    break
+                try:
+                    callback(value)
+                except tk.TclError:
+                    # the screen that asked was closed in the meantime
+                    pass
+        finally:
+            self.window.after(50, self._poll)
+
+    def _on_main(self, function, *args):
+        '''To call a function (e.g. a message box) on the Tk thread from the worker thread and wait for its answer'''
+        answer = []
+        done = threading.Event()
+        def call(_):
+            try:
+                answer.append(function(*args))
+            finally:
+                done.set()
+        self.results.put((call, None))
+        done.wait()
+        return answer[0] if answer else None
+
+    def _progress(self, bar, label):
+        '''To get a progress(done, total) callback for the worker thread that moves a progress bar'''
+        def show(value):
+            done, total = value
+            if total:
+                bar.config(mode='determinate', maximum=total, value=min(done, total))
+                label.config(text=f'{done} / {total}', fg='black')
+            else:
+                bar.config(mode='determinate', maximum=max(done, 1), value=done)
+                label.config(text=f'{done}', fg='black')
+        return lambda done, total: self.results.put((show, (done, total)))
+
+    def _fill_patients(self, combobox):
+        '''To load the patient ids into a combobox without blocking the window'''
+        self._run(self.bmdm.patients, on_done=lambda ids: combobox.config(values=ids))
+
+    def _show_error(self, e, method='UNKNOWN'):
+        '''To log an unexpected error and show it in a message box'''
+        if os.path.exists('.bmdm/history.log') and str(type(e)) != "<class 'RuntimeError'>":
+            self.bmdm._log_activity(method, "ERROR", e)
+        messagebox.showerror(title=str(type(e)).replace('<class', '').replace('>', ''), message=str(e))
+
+    def _ask_overwrite(self, question):
+        '''Ask with a message box before an existing tag is changed'''
+        answer = messagebox.askyesno('تگ تکراری', "A tag with this key already exists.\nAre you sure you want to change it?")
+        if not answer:
+            messagebox.showwarning('تگ تکراری', 'No changes were made.')
+        return answer
+
     def _destroy_frame(self):
         '''To destroy frame and cleaning screen'''
         if self.main_frame:    
@@ -163,15 +243,32 @@ class GUI_BioMedDataManager():
         # Internal function to submit the selected file or folder path for admitting data,
         # and display success message upon completion
         def _admit():
-            try:    
-                self.bmdm.admit(path)
+            # the path is read (and checked) before any widget changes, so a failure never leaves the screen waiting
+            path = path_input.get()
+            if not path:
+                _failed(RuntimeError("First choose a file or folder."))
+                return
+            # the admit runs on the worker thread, the bar follows its batches and 'cancel' stops it after the current one
+            cancel.clear()
+            submit_button.config(state='disabled')
+            cancel_button.config(state='normal')
+            success_label.config(text='...صبر کنید', font=("B Nazanin", 10, 'bold'), fg='black')
+            progress_bar.config(value=0)
+            self._run(self.bmdm.admit, path, batch_size=100, progress=self._progress(progress_bar, success_label),
+                      cancel=cancel, on_done=_admitted, on_error=_failed)
+        def _admitted(result):
+            submit_button.config(state='normal')
+            cancel_button.config(state='disabled')
+            if result and result.get('cancelled'):
+                success_label.config(text='لغو شد', font=("B Nazanin", 10, 'bold'), fg='orange')
+            else:
                 # successful
                 success_label.config(text='با موفقیت انجام شد', font=("B Nazanin", 10, 'bold'), fg='green')
-                # Update the UI label to show success message to the user
-            except Exception as e:
-                if os.path.exists('.bmdm/history.log') and str(type(e)) != "<class 'RuntimeError'>":
-                    self.bmdm._log_activity('admit', "ERROR", e)
-                messagebox.showerror(title=str(type(e)).replace('<class', '').replace('>', ''), message=str(e))
+        def _failed(e):
+            submit_button.config(state='normal')
+            cancel_button.config(state='disabled')
+            success_label.config(text='')
+            self._show_error(e, 'admit')
 
         # Open file dialog to select a single file and update the path input field accordingly
         def choose_file():
@@ -224,6 +321,9 @@ class GUI_BioMedDataManager():
         path_input = tk.Entry(self.main_frame, width=50)
         submit_button = tk.Button(self.main_frame, text='ثبت', command=_admit)
         success_label = tk.Label(self.main_frame)
+        cancel = threading.Event()
+        progress_bar = ttk.Progressbar(self.main_frame, length=300, mode='determinate')
+        cancel_button = tk.Button(self.main_frame, text='لغو', state='disabled', command=cancel.set)
         # Arrange all buttons in a single row with padding for spacing
         label.grid(row=0,column=3, pady=20)
         file.grid(row=0,column=2, pady=20)
@@ -233,14 +333,17 @@ class GUI_BioMedDataManager():
         path_input.grid(row=1,column=2)
         submit_button.grid(row=1,column=0)
         success_label.grid(row=2,column=2)
+        progress_bar.grid(row=3,column=2, pady=10)
+        cancel_button.grid(row=3,column=0)
     
     def stats(self):
         '''to display a collection of data and statical information under management and observation'''
         self._destroy_frame()# Clear the main frame to prepare for stats display
             # Retrieve the statistics dictionary from the data manager
         def _stats():
+            self._run(self.bmdm.stats, on_done=_show, method='stats')
+        def _show(stats_dict):
             # Enable the text widget to update its content
-            stats_dict = self.bmdm.stats()
             stats = f"total_entries: {stats_dict['total_entries']}\nunmanaged_files: {stats_dict['unmanaged_files']}\npatients: {stats_dict['patients']}\nmodalities: {stats_dict['modalities']}\ntags: {stats_dict['tags']}"
             # Insert the formatted stats string into the text widget
             print_label.config(state='normal')
@@ -267,34 +370,21 @@ class GUI_BioMedDataManager():
                 value_input.delete(0, tk.END)
                 value_input.config(state='disabled')
         # Remove the specified tag from the selected data item and show success feedback
-        def _tag_remove():
-            try:
-                # Call data manager to remove tag and show success message
-                self.bmdm.tag(id_filename=id_filename.get(), key=key.get(), value=None, remove=True)
-                success_label.config(text='با موفقیت انجام شد', font=("B Nazanin", 10, 'bold'), fg='green')
-                # Call data manager to remove tag and show success message
-            except Exception as e:
-                if os.path.exists('.bmdm/history.log') and str(type(e)) != "<class 'RuntimeError'>":
-                    self.bmdm._log_activity('admit', "ERROR", e)
-                messagebox.showerror(title=str(type(e)).replace('<class', '').replace('>', ''), message=str(e))
-        def _tag_add():
-            try:
-                self.bmdm.tag(id_filename=id_filename.get(), key=key.get(), value=value.get(), remove=False, is_gui=True)
-                success_label.config(text='با موفقیت انجام شد', font=("B Nazanin", 10, 'bold'), fg='green')
-            except Exception as e:
-                if os.path.exists('.bmdm/history.log') and str(type(e)) != "<class 'RuntimeError'>":
-                    self.bmdm._log_activity('admit', "ERROR", e)
-                messagebox.showerror(title=str(type(e)).replace('<class', '').replace('>', ''), message=str(e))
-                success_label.config(text='')
+        def _tagged(result):
+            success_label.config(text='با موفقیت انجام شد', font=("B Nazanin", 10, 'bold'), fg='green')
+        def _failed(e):
+            success_label.config(text='')
+            self._show_error(e, 'tag')
         def wait_to_submit():
             # Call data manager to remove tag and show success message
             success_label.config(text='...صبر کنید', font=("B Nazanin", 10, 'bold'), fg='black')
             #
             if ch_rbutton.get() == 'add_tag':
-                self.window.after(1000, _tag_add)
+                # the worker thread asks about an existing key through a message box on the Tk thread
+                self._run(self.bmdm.tag, id_filename=id_filename.get(), key=key.get(), value=value.get(), remove=False,
+                          prompt=lambda question: self._on_main(self._ask_overwrite, question), on_done=_tagged, on_error=_failed)
             elif ch_rbutton.get() == 'remove_tag':
-                self.window.after(1000, _tag_remove)
-            # Call data manager to remove tag and show success message
+                self._run(self.bmdm.tag, id_filename=id_filename.get(), key=key.get(), value=None, remove=True, on_done=_tagged, on_error=_failed)
         rudio_frame = tk.Frame(self.main_frame)
         rudio_frame.grid(row=0,column=0)
         #
@@ -318,7 +408,7 @@ class GUI_BioMedDataManager():
         value_input = tk.Entry(input_frame, textvariable=value)
         filename_label = tk.Label(file_frame, text=':آی‌دی مورد نظر را انتخاب کنید')
         filename_input = ttk.Combobox(file_frame, textvariable=id_filename, state='readonly')
-        filename_input['values'] = self.bmdm.stats()['patients'] #
+        self._fill_patients(filename_input) #
         # filename_input.current(0) #
         submit_button = tk.Button(self.main_frame, text='ثبت', command=wait_to_submit)
         success_label = tk.Label(self.main_frame)
@@ -341,8 +431,9 @@ class GUI_BioMedDataManager():
         #
         def _find():
             # Perform the search using filter inputs, format results, and display them in the text widget
-            find_list = self.bmdm.find(filename.get(), patient_id.get(), study_date.get(), modality.get(), tag.get())
-            #
+            self._run(self.bmdm.find, filename.get(), patient_id.get(), study_date.get(), modality.get(), tag.get(),
+                      query=query.get() or None, on_done=_show, method='find')
+        def _show(find_list):
             result_dict = dict()
             for n, item in enumerate(find_list):
                 result_dict[n+1] = item
@@ -364,6 +455,7 @@ class GUI_BioMedDataManager():
         study_date = tk.StringVar(value=None)
         modality = tk.StringVar(value=None)
         tag = tk.StringVar(value=None)
+        query = tk.StringVar(value=None)
         # Entry widgets for the search fields
         filename_label = tk.Label(find_frame, text='نام فایل')
         patient_id_label = tk.Label(find_frame, text='آی‌دی')
@@ -375,6 +467,8 @@ class GUI_BioMedDataManager():
         study_date_input = tk.Entry(find_frame, textvariable=study_date, justify='center')
         modality_input = tk.Entry(find_frame, textvariable=modality, justify='center')
         tag_input = tk.Entry(find_frame, textvariable=tag, justify='center')
+        query_label = tk.Label(find_frame, text='(modality in (CT,MR) and tag:site=lung) کوئری')
+        query_input = tk.Entry(find_frame, textvariable=query, justify='center')
         find_button = tk.Button(self.main_frame, text='پیدا کردن', command=_find)
         # Scrollbar for the results area
         scrollbar = tk.Scrollbar(text_frame)
@@ -391,6 +485,8 @@ class GUI_BioMedDataManager():
         modality_input.grid(row=1,column=3, pady=10)
         tag_label.grid(row=0,column=4)
         tag_input.grid(row=1,column=4, pady=10)
+        query_label.grid(row=2,column=0, columnspan=5)
+        query_input.grid(row=3,column=0, columnspan=5, sticky='we', pady=10)
         find_button.grid(row=1,column=0)
         print_label.pack(side='left', fill='both', expand=True)
         # Link the scrollbar to the text widge
@@ -401,7 +497,8 @@ class GUI_BioMedDataManager():
         self._destroy_frame()
         # Inner function to fetch and display all history logs
         def all_hist():
-            hist = self.bmdm.hist('all')
+            self._run(self.bmdm.hist, 'all', on_done=_show, method='hist')
+        def _show(hist):
             hist = [f"* {item}" for i, item in enumerate(hist)] #
             print_label.config(state='normal')
             print_label.delete('1.0', tk.END)
@@ -431,15 +528,18 @@ class GUI_BioMedDataManager():
         '''To export information'''
         self._destroy_frame()
         # Inner function to perform the actual export
-        def _export():
-            try:
-                self.bmdm.export(id_filename.get(), path)
+        def _exported(result):
+            export_button.config(state='normal')
+            cancel_button.config(state='disabled')
+            if result.get('cancelled'):
+                success_label.config(text='لغو شد', font=("B Nazanin", 10, 'bold'), fg='orange')
+            else:
                 success_label.config(text='با موفقیت انجام شد', font=("B Nazanin", 10, 'bold'), fg='green')
-            except Exception as e:
-                if os.path.exists('.bmdm/history.log') and str(type(e)) != "<class 'RuntimeError'>":
-                    self.bmdm._log_activity('admit', "ERROR", e)
-                messagebox.showerror(title=str(type(e)).replace('<class', '').replace('>', ''), message=str(e))
-                success_label.config(text='')
+        def _failed(e):
+            export_button.config(state='normal')
+            cancel_button.config(state='disabled')
+            success_label.config(text='')
+            self._show_error(e, 'export')
         # Function to open a folder selection dialog
         def choose_folder():  
             global path #
@@ -453,8 +553,19 @@ class GUI_BioMedDataManager():
             path_input.config(state="readonly")
         # Function to display a "please wait" message before exporting
         def wait_to_extract():
+            # the path is read (and checked) before any widget changes, so a failure never leaves the screen waiting
+            path = path_input.get()
+            if not path:
+                _failed(RuntimeError("First choose the export folder."))
+                return
             success_label.config(text='...صبر کنید', font=("B Nazanin", 10, 'bold'), fg='black')
-            self.window.after(1000, _export) #
+            # the export runs on the worker thread, 'cancel' stops it between entries
+            cancel.clear()
+            export_button.config(state='disabled')
+            cancel_button.config(state='normal')
+            progress_bar.config(value=0)
+            self._run(self.bmdm.export, id_filename.get(), path, progress=self._progress(progress_bar, success_label),
+                      cancel=cancel, on_done=_exported, on_error=_failed)
         # Frame for file selection controls
         file_frame = tk.Frame(self.main_frame)
         file_frame.grid(row=0,column=0, pady=20)
@@ -466,12 +577,15 @@ class GUI_BioMedDataManager():
         # Label for file selection
         filename_label = tk.Label(file_frame, text='آی‌دی فایل مورد نظر برای اسخراج را انتخاب کنید')
         filename_input = ttk.Combobox(file_frame, textvariable=id_filename, state='readonly')
-        filename_input['values'] = self.bmdm.stats()['patients'] #
+        self._fill_patients(filename_input) #
         # filename_input.current(0) #
         file_button = tk.Button(folder_frame, text='مسبر استخراج را وارد کنید', command=choose_folder)
         path_input = tk.Entry(folder_frame, width=50, state='readonly')
         export_button = tk.Button(self.main_frame, text='استخراج اطلاعات', command=wait_to_extract)
         success_label = tk.Label(self.main_frame)
+        cancel = threading.Event()
+        progress_bar = ttk.Progressbar(self.main_frame, length=300, mode='determinate')
+        cancel_button = tk.Button(self.main_frame, text='لغو', state='disabled', command=cancel.set)
         # Place UI elements in the grid
         filename_label.grid(row=0,column=1)
         filename_input.grid(row=0,column=0,pady=10)
@@ -479,25 +593,23 @@ class GUI_BioMedDataManager():
         path_input.grid(row=0,column=0)
         export_button.grid(row=2,column=0)
         success_label.grid(row=3,column=0,pady=10)
+        progress_bar.grid(row=4,column=0)
+        cancel_button.grid(row=5,column=0,pady=10)
 
     def remove(self):
         '''To remove information'''
         self._destroy_frame()
         # Inner function to remove the selected file
-        def _remove():
-            try:
-                self.bmdm.remove(id_filename.get())
-                success_label.config(text='با موفقیت انجام شد', font=("B Nazanin", 10, 'bold'), fg='green')
-                filename_input['values'] = self.bmdm.stats()['patients']
-            except Exception as e:
-                if os.path.exists('.bmdm/history.log') and str(type(e)) != "<class 'RuntimeError'>":
-                    self.bmdm._log_activity('admit', "ERROR", e)
-                messagebox.showerror(title=str(type(e)).replace('<class', '').replace('>', ''), message=str(e))
-                success_label.config(text='')
-        # Function to show "please wait" before actually removing
+        def _removed(result):
+            success_label.config(text='با موفقیت انجام شد', font=("B Nazanin", 10, 'bold'), fg='green')
+            self._fill_patients(filename_input)
+        def _failed(e):
+            success_label.config(text='')
+            self._show_error(e, 'remove')
+        # Function to show "please wait" while the entry is removed
         def wait_to_remove():
             success_label.config(text='...صبر کنید', font=("B Nazanin", 10, 'bold'), fg='black')
-            self.window.after(1000, _remove) #
+            self._run(self.bmdm.remove, id_filename.get(), on_done=_removed, on_error=_failed)
         # Frame for file selection controls
         file_frame = tk.Frame(self.main_frame)
         file_frame.grid(row=0,column=0, pady=20)
@@ -506,7 +618,7 @@ class GUI_BioMedDataManager():
         # Label for file selection
         filename_label = tk.Label(file_frame, text='آی‌دی فایل مورد نظر برای حذف را انتخاب کنید')
         filename_input = ttk.Combobox(file_frame, textvariable=id_filename, state='readonly')
-        filename_input['values'] = self.bmdm.stats()['patients'] #
+        self._fill_patients(filename_input) #
         # filename_input.current(0) #
         remove_button = tk.Button(self.main_frame, text='حذف کردن', command=wait_to_remove)
         success_label = tk.Label(self.main_frame)
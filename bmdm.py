@@ -1,10 +1,25 @@
-from BioMedDataManager import BioMedDataManager
+from BioMedDataManager import BioMedDataManager, search_filters, make_cursor, read_cursor
+from server_bmdm import call, serve
 import argparse
 import json
 import os
 import sys
-import tkinter as tk
-from tkinter import messagebox
+
+def read_tag_operations(path: str):
+    """
+    To read bulk tag operations from a JSON Lines file (one object per line) or a CSV file with a header
+    """
+    with open(path, "r", encoding="utf-8", newline="") as o_f:
+        if path.endswith((".jsonl", ".json")):
+            operations = [json.loads(line) for line in o_f if line.strip()]
+        else:
+            import csv
+            operations = [dict(row) for row in csv.DictReader(o_f)]
+    for operation in operations:
+        # a CSV cell is text, so "remove" is a yes/no flag there
+        if isinstance(operation.get("remove"), str):
+            operation["remove"] = operation["remove"].strip().lower() in ("1", "true", "yes", "y")
+    return operations
 
 # main function
 def main():
@@ -20,39 +35,93 @@ def main():
     config = subparsers.add_parser("config", help="Set user configuration")
     config.add_argument("--user.name", dest="user_name", help="User's full name")
     config.add_argument("--user.email", dest="user_email", help="User's email address")
+    config.add_argument("--history.max-size", dest="history_max_size", type=int, help="Rotate the history log once it reaches this many bytes (0 = never)")
+    config.add_argument("--history.daily", dest="history_daily", choices=("on", "off"), help="Rotate the history log every day")
+    config.add_argument("--history.compress", dest="history_compress", choices=("on", "off"), help="Gzip rotated history segments")
+    config.add_argument("--history.format", dest="history_format", choices=("text", "jsonl"), help="Write history as text lines or JSON Lines")
 
     # admit
     admit = subparsers.add_parser("admit", help="Add file or directory to BMDM")
     admit.add_argument("path", help="Path to a file or directory")
+    admit.add_argument("--batch-size", type=int, default=500, help="Number of files merged into the index per write (directories only)")
+    admit.add_argument("--workers", type=int, default=1, help="Number of processes used to extract metadata (directories only)")
+    admit.add_argument("-r", "--recursive", action="store_true", help="Also admit files in sub-directories")
+    admit.add_argument("--max-depth", type=int, help="Maximum sub-directory depth to descend into (implies --recursive)")
+    admit.add_argument("--include", action="append", help="Only admit files whose relative path matches this glob (repeatable)")
+    admit.add_argument("--exclude", action="append", help="Skip files and directories whose relative path matches this glob (repeatable)")
+    admit.add_argument("--force", action="store_true", help="Re-admit files even if they have not changed since the last admit")
 
     # stats
-    subparsers.add_parser("stats", help="Show general statistics")
+    stats = subparsers.add_parser("stats", help="Show general statistics")
+    stats.add_argument("path", nargs="?", default="./", help="Directory searched for unmanaged files (default: current directory)")
+    stats.add_argument("-r", "--recursive", action="store_true", help="Also search sub-directories for unmanaged files")
+    stats.add_argument("--detailed", action="store_true", help="Show counts per patient, modality, tag value and study month")
 
     # tag
     tag = subparsers.add_parser("tag", help="Add or remove tags from an entry")
-    tag.add_argument("entry", help="Entry ID or filename")
+    tag.add_argument("entry", nargs="?", help="Entry ID or filename")
     tag.add_argument("--add-tag", help="Add tag in format key=value")
     tag.add_argument("--remove-tag", help="Remove tag by key")
+    tag.add_argument("--from-file", help="Apply the tag operations of a CSV (columns id,key,value,remove) or JSON Lines file in one write")
+    tag.add_argument("--query", help="Add / remove the tag on every entry matching this find query")
+    tag.add_argument("--on-conflict", choices=("overwrite", "skip", "fail"), default="fail", help="For --from-file / --query: what to do with an existing key, a missing key or entry (default: fail, nothing is changed)")
 
     # find
     find = subparsers.add_parser("find", help="Search for matching entries")
     find.add_argument("--patient-id", help="Filter by patient ID")
     find.add_argument("--modality", help="Filter by modality")
-    find.add_argument("--study-date", help="Study date or range (YYYYMMDD or YYYYMMDD-YYYYMMDD)")
+    find.add_argument("--study-date", help="Study date or range (YYYYMMDD or YYYY-MM-DD, YYYYMMDD-YYYYMMDD, YYYYMMDD- or -YYYYMMDD)")
     find.add_argument("--tag", help="Filter by tag (key=value)")
+    find.add_argument("--query", help="Query expression, e.g. \"modality in (CT,MR) and tag:site=lung and not patient_id~^TEST\"")
+    find.add_argument("--limit", type=int, help="Return at most this many entries")
+    find.add_argument("--offset", type=int, default=0, help="Skip this many entries first")
+    find.add_argument("--cursor", help="Continue a previous search (the next_cursor it printed)")
+    find.add_argument("--fields", help="Comma-separated fields to output (\"hash\" is the entry key)")
+    find.add_argument("--count-only", action="store_true", help="Only print the number of matching entries")
 
     # hist
     hist = subparsers.add_parser("hist", help="View history")
     hist.add_argument("--limit", type=int, help="Limit the number of entries")
+    hist.add_argument("--since", help="Only entries at or after this time (ISO, e.g. 2024-05-01 or 2024-05-01T10:00)")
+    hist.add_argument("--until", help="Only entries at or before this time (ISO prefix, inclusive)")
+    hist.add_argument("--command", dest="record_command", help="Only entries of this command (e.g. tag, admit)")
+    hist.add_argument("--activity", help="Only entries of this activity type (e.g. ADD_TAG, REMOVE)")
+    hist.add_argument("--user", help="Only entries by this manager name or email")
+    hist.add_argument("--target", help="Only entries that touched this patient id, filename or hash")
 
     # export
-    export = subparsers.add_parser("export", help="Export an entry")
-    export.add_argument("entry_id", help="ID of the entry to export")
-    export.add_argument("target_directory", help="Target directory for exported data")
+    export = subparsers.add_parser("export", help="Export entries")
+    export.add_argument("entry_id", nargs="*", help="Patient IDs, filenames or entry hashes to export (all entries of a patient)")
+    export.add_argument("target_directory", help="Target directory, or a .zip, .tar.gz or .jsonl archive to stream the entries into")
+    export.add_argument("--query", help="Also export every entry matching this find query")
+    export.add_argument("--workers", type=int, default=1, help="Number of threads writing files (directory targets only)")
+
+    # export-table
+    export_table = subparsers.add_parser("export-table", help="Write the index as a CSV (or Parquet / Arrow) table for analytics")
+    export_table.add_argument("target_file", help="Table file: .csv, or .parquet / .arrow (needs pyarrow)")
+    export_table.add_argument("--chunk-size", type=int, default=10000, help="Number of rows written at a time")
+    export_table.add_argument("--incremental", action="store_true", help="Only append entries changed since the last export to this CSV file")
 
     # remove
-    remove = subparsers.add_parser("remove", help="Remove an entry")
-    remove.add_argument("entry_id", help="ID of the entry to remove")
+    remove = subparsers.add_parser("remove", help="Remove entries")
+    remove.add_argument("entry_id", nargs="+", help="Patient IDs, filenames or entry hashes to remove (all entries of a patient)")
+
+    # serve
+    serve_parser = subparsers.add_parser("serve", help="Run a daemon that keeps the index in memory for other calls")
+    serve_parser.add_argument("--port", type=int, default=0, help="Local port to listen on (default: any free port)")
+
+    # compact
+    subparsers.add_parser("compact", help="Fold the index journal into a fresh index snapshot")
+
+    # migrate
+    migrate = subparsers.add_parser("migrate", help="Convert the index into another backend")
+    migrate.add_argument("--to", choices=("sqlite", "compact"), default="sqlite", help="sqlite (default) or compact, a memory-mapped index for very large archives")
+
+    # gc
+    subparsers.add_parser("gc", help="Delete stored objects that no entry refers to")
+
+    # repack
+    subparsers.add_parser("repack", help="Move loose objects into pack files and delete orphaned ones")
 
     args = parser.parse_args()
     manager = BioMedDataManager()
@@ -65,15 +134,47 @@ def main():
             result = manager.boot()
         elif command == "config":
             method = command
-            result = manager.config(name=args.user_name, email=args.user_email)
+            history = {}
+            if args.history_max_size is not None:
+                history["max_bytes"] = args.history_max_size
+            if args.history_daily:
+                history["daily"] = args.history_daily == "on"
+            if args.history_compress:
+                history["compress"] = args.history_compress == "on"
+            if args.history_format:
+                history["format"] = args.history_format
+            result = manager.config(name=args.user_name, email=args.user_email, history=history)
         elif command == "admit":
             method = command
-            result = manager.admit(args.path)
+            result = call(
+                manager, "admit",
+                file_path=args.path,
+                batch_size=args.batch_size,
+                workers=args.workers,
+                recursive=args.recursive,
+                include=args.include,
+                exclude=args.exclude,
+                max_depth=args.max_depth,
+                force=args.force
+            )
         elif command == "stats":
             method = command
-            result = manager.stats()
+            result = call(manager, "stats", path=args.path, recursive=args.recursive, detailed=args.detailed)
+        elif command == "tag" and (args.from_file or args.query):
+            method = command
+            if args.from_file:
+                operations = read_tag_operations(args.from_file)
+            else:
+                if not (args.add_tag or args.remove_tag):
+                    raise RuntimeError("--query needs --add-tag or --remove-tag.")
+                key, _, value = (args.add_tag or args.remove_tag).partition("=")
+                hashes = call(manager, "iter_find", query=args.query, fields=["hash"])
+                operations = [{"hash": item["hash"], "key": key, "value": value, "remove": not args.add_tag} for item in hashes]
+            result = call(manager, "tag_many", operations=operations, on_conflict=args.on_conflict)
         elif command == "tag":
             method = command
+            if not args.entry:
+                raise RuntimeError("An entry ID or filename is needed (or --from-file / --query).")
             if args.add_tag:
                 key_value = args.add_tag.split('=', 1)
                 key = key_value[0]
@@ -84,7 +185,8 @@ def main():
                 key = args.remove_tag
                 value = None
 
-            result = manager.tag(
+            result = call(
+                manager, "tag",
                 id_filename=args.entry,
                 key=key,
                 value=value,
@@ -92,45 +194,77 @@ def main():
             )
         elif command == "find":
             method = command
-            study_date = args.study_date
-            if study_date and "-" in study_date:
-                start, end = study_date.split("-")
-                study_date = (start.strip(), end.strip())
-            result = manager.find(
-                patient_id=args.patient_id,
-                modality=args.modality,
-                study_date=study_date,
-                tag=args.tag
-            )
+            filters = dict(patient_id=args.patient_id, modality=args.modality, study_date=args.study_date, tag=args.tag, query=args.query)
+            if args.count_only:
+                result = call(manager, "find_count", **filters)
+            else:
+                fields = [field.strip() for field in args.fields.split(",")] if args.fields else None
+                entries = call(manager, "iter_find", offset=args.offset, limit=args.limit, fields=fields, cursor=args.cursor, **filters)
+                # one JSON object per line, written as soon as it is found
+                returned = 0
+                for entry in entries:
+                    print(json.dumps(entry, ensure_ascii=False), flush=True)
+                    returned += 1
+                if args.limit is not None and returned == args.limit:
+                    offset = read_cursor(args.cursor, search_filters(**filters)) if args.cursor else args.offset
+                    print(json.dumps({"next_cursor": make_cursor(search_filters(**filters), offset + returned)}), file=sys.stderr)
         elif command == "hist":
             method = command
+            filters = dict(since=args.since, until=args.until, command=args.record_command, activity=args.activity, user=args.user, target=args.target)
             if args.limit:
-                result = manager.hist(args.limit)
+                result = manager.hist(args.limit, **filters)
+            elif any(filters.values()):
+                result = manager.hist('all', **filters)
             else:
                 result = manager.hist(5)
         elif command == "export":
             method = command
-            result = manager.export(args.entry_id, args.target_directory)
+            result = call(manager, "export", id=args.entry_id, path=args.target_directory, query=args.query, workers=args.workers)
+        elif command == "export-table":
+            method = "export_table"
+            result = call(manager, "export_table", path=args.target_file, chunk_size=args.chunk_size, incremental=args.incremental)
         elif command == "remove":
             method = command
-            result = manager.remove(args.entry_id)
+            result = call(manager, "remove", id_filename=args.entry_id)
+        elif command == "serve":
+            method = command
+            result = serve(manager, port=args.port)
+        elif command == "compact":
+            method = command
+            result = call(manager, "compact")
+        elif command == "migrate":
+            method = command
+            result = call(manager, "migrate", to=args.to)
+        elif command == "gc":
+            method = command
+            result = call(manager, "gc")
+        elif command == "repack":
+            method = command
+            result = call(manager, "repack")
         if result is not None:
             print(json.dumps(result, indent=2))
 
+    except BrokenPipeError:
+        # the reader of a streamed output (e.g. 'head') stopped early, the rest is thrown away quietly
+        os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
     except Exception as e:
         if os.path.exists('.bmdm/history.log') and str(type(e)) != "<class 'RuntimeError'>":
             manager._log_activity(method, "ERROR", e)
         print(f"[ERROR] {e}")
 
-if len(sys.argv) != 1:
-    main()
-else:
-    from GUI_bmdm import GUI_BioMedDataManager
-    try:   
-        window = tk.Tk()
-        bmdm = GUI_BioMedDataManager(window)
-        window.mainloop()
-    except Exception as e:
-        if os.path.exists('.bmdm/history.log'):
-            BioMedDataManager._log_activity('UNKNOWN', "ERROR", e)
-        messagebox.showerror(title=str(type(e)).replace('<class', '').replace('>', ''), message=str(e))
\ No newline at end of file
+if __name__ == "__main__":
+    if len(sys.argv) != 1:
+        main()
+    else:
+        # tkinter is only loaded for the GUI, so CLI calls start fast and work without Tk
+        import tkinter as tk
+        from tkinter import messagebox
+        from GUI_bmdm import GUI_BioMedDataManager
+        try:   
+            window = tk.Tk()
+            bmdm = GUI_BioMedDataManager(window)
+            window.mainloop()
+        except Exception as e:
+            if os.path.exists('.bmdm/history.log'):
+                BioMedDataManager._log_activity('UNKNOWN', "ERROR", e)
+            messagebox.showerror(title=str(type(e)).replace('<class', '').replace('>', ''), message=str(e))
\ No newline at end of file
@@ -0,0 +1,543 @@
+# libraries
+import os
+import sys
+import json
+import struct
+from array import array
+from collections.abc import Mapping
+from storage_bmdm import Aggregates, apply_record, date_key, date_bounds, read_journal, append_journal, journal_lock, record_changes
+
+# fields kept in the string table, in record order
+FIELDS = ("filename", "patient_id", "study_date", "modality")
+# string id of a field that is missing or not a string (its value is then kept in the entry data)
+MISSING = 0xFFFFFFFF
+# magic, version, entries, strings, dated entries, tag postings, then the offsets of the sections
+HEADER = struct.Struct("<4sIQQQQQQQQQQQQ")
+MAGIC = b"BMIX"
+# format written by 'write_index', version 1 files (8 character keys) are still read
+VERSION = 2
+# width of the key field by format version, a shorter key is padded with \0 and still matched exactly
+KEY_SIZES = {1: 8, 2: 64}
+KEY_SIZE = KEY_SIZES[VERSION]
+# key, string ids of FIELDS, study date as YYYYMMDD (0 if none), offset and length of the other fields (JSON)
+RECORDS = {version: struct.Struct(f"<{size}s4IIQI") for version, size in KEY_SIZES.items()}
+RECORD = RECORDS[VERSION]
+POSTING = struct.Struct("<III")
+UINT = struct.Struct("<I")
+OFFSET = struct.Struct("<Q")
+
+def _uint_array(values):
+    """
+    To pack a list of ints as little-endian uint32
+    """
+    packed = array("I", values)
+    if sys.byteorder == "big":
+        packed.byteswap()
+    return packed.tobytes()
+
+def _fits(key, size: int = KEY_SIZE):
+    """
+    True if 'key' fits the key field as it is, a longer key is never cut down to match another one
+    """
+    return isinstance(key, str) and 0 < len(key) <= size and key.isascii() and "\0" not in key
+
+def write_index(index_file: str, items):
+    """
+    To write (hash, entry) pairs as a compact index file, returns the number of entries
+    * sections: sorted string table, fixed-width records, record numbers sorted by key / by each field / by date,
+      sorted (tag, value, record) postings and the JSON data of the remaining fields
+    """
+    keys = []
+    sids = []
+    dates = []
+    blobs = []
+    tags = []
+    strings = set()
+    for key, entry in items:
+        values = [entry.get(field) for field in FIELDS]
+        values = [value if isinstance(value, str) else None for value in values]
+        strings.update(value for value in values if value is not None)
+        # fields in the string table are not repeated in the data
+        rest = {name: value for name, value in entry.items() if not (name in FIELDS and isinstance(value, str))}
+        for tag, value in rest.get("tags", {}).items():
+            if isinstance(tag, str) and isinstance(value, str):
+                strings.update((tag, value))
+                tags.append((tag, value, len(keys)))
+        if not _fits(key):
+            raise RuntimeError(f"The key {key!r} can not be stored in a compact index, keys are up to {KEY_SIZE} ASCII characters.")
+        keys.append(key.encode("ascii").ljust(KEY_SIZE, b"\0"))
+        sids.append(values)
+        dates.append(int(date_key(entry.get("study_date")) or 0))
+        blobs.append(json.dumps(rest, ensure_ascii=False).encode("utf-8"))
+    count = len(keys)
+    # strings are ordered by their utf-8 bytes, so a lookup can bisect the table
+    encoded = sorted(text.encode("utf-8") for text in strings)
+    sid = {text.decode("utf-8"): i for i, text in enumerate(encoded)}
+    sids = [[MISSING if value is None else sid[value] for value in values] for values in sids]
+
+    temp_file = f"{index_file}.tmp"
+    with open(temp_file, "wb") as f:
+        f.write(b"\0" * HEADER.size)
+        sections = []
+        # string offsets and bytes
+        sections.append(f.tell())
+        position = 0
+        for text in encoded:
+            f.write(OFFSET.pack(position))
+            position += len(text)
+        f.write(OFFSET.pack(position))
+        sections.append(f.tell())
+        f.write(b"".join(encoded))
+        # records
+        sections.append(f.tell())
+        position = 0
+        for key, values, date, blob in zip(keys, sids, dates, blobs):
+            f.write(RECORD.pack(key, *values, date, position, len(blob)))
+            position += len(blob)
+        # record numbers by key
+        sections.append(f.tell())
+        f.write(_uint_array(sorted(range(count), key=keys.__getitem__)))
+        # record numbers by the string id of each field, one array per field
+        sections.append(f.tell())
+        for n in range(len(FIELDS)):
+            f.write(_uint_array(sorted(range(count), key=lambda i: (sids[i][n], i))))
+        # record numbers of dated entries by date
+        sections.append(f.tell())
+        dated = sorted((date, i) for i, date in enumerate(dates) if date)
+        f.write(_uint_array([i for _, i in dated]))
+        # tag postings
+        sections.append(f.tell())
+        for posting in sorted((sid[tag], sid[value], i) for tag, value, i in tags):
+            f.write(POSTING.pack(*posting))
+        # data
+        sections.append(f.tell())
+        for blob in blobs:
+            f.write(blob)
+        f.seek(0)
+        f.write(HEADER.pack(MAGIC, VERSION, count, len(encoded), len(dated), len(tags), *sections))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temp_file, index_file)
+    return count
+
+class Entry(Mapping):
+    """
+    # One entry of a compact index, it reads like the entry dict of the other stores
+    * the string fields are decoded when the entry is created, the other fields on first access
+    """
+    __slots__ = ("key", "values", "raw", "extra")
+    def __init__(self, key: str, values: tuple, raw: bytes):
+        self.key = key
+        self.values = values
+        self.raw = raw
+        self.extra = None
+
+    def _rest(self):
+        if self.extra is None:
+            self.extra = json.loads(self.raw)
+            self.raw = None
+        return self.extra
+
+    def __getitem__(self, name):
+        if name in FIELDS and self.values[FIELDS.index(name)] is not None:
+            return self.values[FIELDS.index(name)]
+        return self._rest()[name]
+
+    def __iter__(self):
+        for field, value in zip(FIELDS, self.values):
+            if value is not None:
+                yield field
+        yield from self._rest()
+
+    def __len__(self):
+        return sum(value is not None for value in self.values) + len(self._rest())
+
+    def __repr__(self):
+        return f"Entry({self.key!r}, {dict(self)!r})"
+
+class CompactIndex:
+    """
+    # Read-only view of a compact index file through mmap, lookups are binary searches over its sections
+    """
+    def __init__(self, index_file: str):
+        import mmap
+        with open(index_file, "rb") as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        (magic, version, self.count, self.strings, self.dated, self.postings, self.string_offsets, self.string_data,
+         self.records, self.by_key, self.by_field, self.by_date, self.tags, self.data) = HEADER.unpack_from(self.map, 0)
+        if magic != MAGIC or version not in KEY_SIZES:
+            self.map.close()
+            raise RuntimeError(f"{index_file} is not a compact index.")
+        self.key_size = KEY_SIZES[version]
+        self.record = RECORDS[version]
+
+    def close(self):
+        self.map.close()
+
+    def _bisect(self, low: int, high: int, value_at, target):
+        """
+        To find the first position in [low, high) whose value is not below 'target'
+        """
+        while low < high:
+            middle = (low + high) // 2
+            if value_at(middle) < target:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def _uints(self, section: int, low: int, high: int):
+        return list(struct.unpack_from(f"<{high - low}I", self.map, section + 4 * low))
+
+    def string(self, sid: int):
+        start, end = struct.unpack_from("<QQ", self.map, self.string_offsets + 8 * sid)
+        return self.map[self.string_data + start:self.string_data + end].decode("utf-8")
+
+    def string_id(self, text: str):
+        """
+        To get the id of a string in the table, None if it is not there
+        """
+        target = text.encode("utf-8")
+        def bytes_at(sid):
+            start, end = struct.unpack_from("<QQ", self.map, self.string_offsets + 8 * sid)
+            return self.map[self.string_data + start:self.string_data + end]
+        sid = self._bisect(0, self.strings, bytes_at, target)
+        if sid < self.strings and bytes_at(sid) == target:
+            return sid
+        return None
+
+    def key(self, i: int):
+        start = self.records + i * self.record.size
+        return self.map[start:start + self.key_size].rstrip(b"\0").decode("ascii")
+
+    def date(self, i: int):
+        return UINT.unpack_from(self.map, self.records + i * self.record.size + self.key_size + 16)[0]
+
+    def entry(self, i: int):
+        key, *values, _, offset, length = self.record.unpack_from(self.map, self.records + i * self.record.size)
+        values = tuple(None if sid == MISSING else self.string(sid) for sid in values)
+        start = self.data + offset
+        return Entry(key.rstrip(b"\0").decode("ascii"), values, self.map[start:start + length])
+
+    def locate(self, key: str):
+        """
+        To get the record number of a key, None if it is not in the file (or could not be)
+        """
+        if not _fits(key, self.key_size):
+            return None
+        target = key.encode("ascii").ljust(self.key_size, b"\0")
+        j = self._bisect(0, self.count, self._key_at, target)
+        if j < self.count and self._key_at(j) == target:
+            return UINT.unpack_from(self.map, self.by_key + 4 * j)[0]
+        return None
+
+    def _key_at(self, j: int):
+        """
+        To get the padded key of the j-th record in key order
+        """
+        i = UINT.unpack_from(self.map, self.by_key + 4 * j)[0]
+        return self.map[self.records + i * self.record.size:self.records + i * self.record.size + self.key_size]
+
+    def with_prefix(self, prefix: str):
+        """
+        To get the record numbers (in key order) whose key starts with 'prefix'
+        """
+        if not _fits(prefix, self.key_size):
+            return []
+        target = prefix.encode("ascii")
+        j = self._bisect(0, self.count, self._key_at, target)
+        numbers = []
+        while j < self.count and self._key_at(j).startswith(target):
+            numbers.append(UINT.unpack_from(self.map, self.by_key + 4 * j)[0])
+            j += 1
+        return numbers
+
+    def with_value(self, field: int, value):
+        """
+        To get the record numbers (in index order) whose field equals 'value'
+        """
+        sid = self.string_id(value) if isinstance(value, str) else None
+        if sid is None:
+            return []
+        section = self.by_field + 4 * self.count * field
+        def sid_at(j):
+            i = UINT.unpack_from(self.map, section + 4 * j)[0]
+            return UINT.unpack_from(self.map, self.records + i * self.record.size + self.key_size + 4 * field)[0]
+        low = self._bisect(0, self.count, sid_at, sid)
+        high = self._bisect(low, self.count, sid_at, sid + 1)
+        return self._uints(section, low, high)
+
+    def with_date(self, start: str, end: str):
+        """
+        To get the record numbers (in date order) whose study date is within the inclusive 'YYYYMMDD' bounds
+        """
+        def date_at(j):
+            i = UINT.unpack_from(self.map, self.by_date + 4 * j)[0]
+            return UINT.unpack_from(self.map, self.records + i * self.record.size + self.key_size + 16)[0]
+        low = self._bisect(0, self.dated, date_at, int(start)) if start else 0
+        high = self._bisect(low, self.dated, date_at, int(end) + 1) if end else self.dated
+        return self._uints(self.by_date, low, high)
+
+    def with_tag(self, tag: str, value: str):
+        """
+        To get the record numbers (in index order) tagged with tag=value
+        """
+        tag_id, value_id = self.string_id(tag), self.string_id(value)
+        if tag_id is None or value_id is None:
+            return []
+        def pair_at(j):
+            return POSTING.unpack_from(self.map, self.tags + POSTING.size * j)[:2]
+        low = self._bisect(0, self.postings, pair_at, (tag_id, value_id))
+        high = self._bisect(low, self.postings, pair_at, (tag_id, value_id + 1))
+        return [POSTING.unpack_from(self.map, self.tags + POSTING.size * j)[2] for j in range(low, high)]
+
+def entry_matches(entry, filename=None, patient_id=None, study_date=None, modality=None, tag=None):
+    """
+    To check an entry against query filters in memory, 'study_date' may be a (start, end) range
+    """
+    for field, value in zip(FIELDS, (filename, patient_id, None if isinstance(study_date, tuple) else study_date, modality)):
+        if value and entry.get(field) != value:
+            return False
+    if isinstance(study_date, tuple):
+        start, end = date_bounds(study_date)
+        key = date_key(entry.get("study_date"))
+        if key is None or (start and key < start) or (end and key > end):
+            return False
+    if tag:
+        key, value = tag.split('=', 1)
+        if entry.get("tags", {}).get(key) != value:
+            return False
+    return True
+
+class CompactIndexStore:
+    """
+    # Index stored as a memory-mapped 'index.bin' (see 'write_index') plus an append-only journal of mutations
+    * only the entries a command touches are decoded, the file itself is never loaded
+    * mutations since the last compact are kept in memory on top of the file
+    * It has the same methods as 'JsonIndexStore'
+    """
+    name = "compact"
+    index_name = "index.bin"
+    # the journal is folded into index.bin once it grows past this size (bytes)
+    journal_limit = 16 * 1024 * 1024
+    def __init__(self, bmdm_dir: str = ".bmdm"):
+        self.index_file = f"{bmdm_dir}/{self.index_name}"
+        self.journal_file = f"{bmdm_dir}/{self.index_name}.journal"
+        self.index = None
+        self.snapshot = None
+        # {key: entry, None once removed} for the journal records replayed so far
+        self.overlay = {}
+        self.journal_offset = 0
+        self.totals = Aggregates(f"{bmdm_dir}/stats.json")
+
+    @staticmethod
+    def _signature(path: str):
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            return None
+        return stat.st_mtime_ns, stat.st_size
+
+    def close(self):
+        if self.index is not None:
+            self.index.close()
+            self.index = None
+
+    def _open(self):
+        """
+        To map index.bin and replay the journal records written since the last call
+        """
+        snapshot = self._signature(self.index_file)
+        journal_size = os.path.getsize(self.journal_file) if os.path.isfile(self.journal_file) else 0
+        if self.index is None or snapshot != self.snapshot or journal_size < self.journal_offset:
+            self.close()
+            self.index = CompactIndex(self.index_file)
+            self.snapshot = snapshot
+            self.overlay = {}
+            self.journal_offset = 0
+        if journal_size > self.journal_offset:
+            for record, size in read_journal(self.journal_file, self.journal_offset):
+                self._apply(record)
+                self.journal_offset += size
+        return self.index
+
+    def _base(self, key: str):
+        i = self.index.locate(key)
+        return None if i is None else self.index.entry(i)
+
+    def _current(self, key: str):
+        if key in self.overlay:
+            return self.overlay[key]
+        return self._base(key)
+
+    def _apply(self, record: dict):
+        key = record["key"]
+        if record["op"] == "admit":
+            self.overlay[key] = record["entry"]
+        elif record["op"] == "remove":
+            self.overlay[key] = None
+        else:
+            entry = self._current(key)
+            if entry is None:
+                return
+            # an entry from the file is copied into the overlay before it changes
+            state = {key: dict(entry, tags=dict(entry.get("tags", {})))}
+            apply_record(state, record)
+            self.overlay[key] = state[key]
+
+    def load(self):
+        return dict(self.items())
+
+    def get(self, key: str):
+        self._open()
+        return self._current(key)
+
+    def items(self):
+        index = self._open()
+        overlay = self.overlay
+        for i in range(index.count):
+            key = index.key(i)
+            if key in overlay:
+                if overlay[key] is not None:
+                    yield key, overlay[key]
+            else:
+                yield key, index.entry(i)
+        for key, entry in overlay.items():
+            if entry is not None and index.locate(key) is None:
+                yield key, entry
+
+    def with_prefix(self, prefix: str):
+        index = self._open()
+        overlay = self.overlay
+        keys = [key for key in map(index.key, index.with_prefix(prefix)) if not (key in overlay and overlay[key] is None)]
+        keys += [key for key, entry in overlay.items() if entry is not None and key.startswith(prefix) and key not in keys]
+        return keys
+
+    def keys(self):
+        index = self._open()
+        keys = {index.key(i) for i in range(index.count)}
+        for key, entry in self.overlay.items():
+            if entry is None:
+                keys.discard(key)
+            else:
+                keys.add(key)
+        return keys
+
+    def _matches(self, filename, patient_id, study_date, modality, tag):
+        """
+        To get the (position, key, entry) of the matches and their number, base entries are not decoded yet (None)
+        """
+        index = self._open()
+        ranged = isinstance(study_date, tuple)
+        sets = []
+        for field, value in enumerate((filename, patient_id, None if ranged else study_date, modality)):
+            if value:
+                sets.append(index.with_value(field, value))
+        if tag:
+            key, value = tag.split('=', 1)
+            sets.append(index.with_tag(key, value))
+        if sets:
+            sets.sort(key=len)
+            hits = set(sets[0])
+            for numbers in sets[1:]:
+                if not hits:
+                    break
+                hits &= set(numbers)
+        if ranged:
+            dated = index.with_date(*date_bounds(study_date))
+            hits = dated if not sets else [i for i in dated if i in hits]
+        elif sets:
+            hits = sorted(hits)
+        else:
+            hits = range(index.count)
+        overlay = self.overlay
+        if not overlay:
+            return ((i, None, None) for i in hits), len(hits)
+        results = [(i, key, None) for i in hits for key in (index.key(i),) if key not in overlay]
+        # entries changed since the last compact are matched in memory and put back in their place
+        changed = False
+        for order, (key, entry) in enumerate(overlay.items()):
+            if entry is not None and entry_matches(entry, filename, patient_id, study_date, modality, tag):
+                position = index.locate(key)
+                results.append((index.count + order if position is None else position, key, entry))
+                changed = True
+        if changed:
+            if ranged:
+                results.sort(key=lambda result: (str(index.date(result[0])) if result[2] is None else date_key(result[2].get("study_date")), result[0]))
+            else:
+                results.sort(key=lambda result: result[0])
+        return results, len(results)
+
+    def query(self, filename=None, patient_id=None, study_date=None, modality=None, tag=None):
+        return list(self.iter_query(filename, patient_id, study_date, modality, tag))
+
+    def iter_query(self, filename=None, patient_id=None, study_date=None, modality=None, tag=None):
+        index = self._open()
+        results, _ = self._matches(filename, patient_id, study_date, modality, tag)
+        for i, key, entry in results:
+            if entry is None:
+                entry = index.entry(i)
+                key = entry.key
+            yield key, entry
+
+    def count(self, filename=None, patient_id=None, study_date=None, modality=None, tag=None):
+        return self._matches(filename, patient_id, study_date, modality, tag)[1]
+
+    def state(self):
+        journal_size = os.path.getsize(self.journal_file) if os.path.isfile(self.journal_file) else 0
+        return ["compact", list(self._signature(self.index_file) or []), journal_size]
+
+    def aggregates(self):
+        # another process may have written since, its saved totals are read before anything is recounted
+        if self.totals.state != self.state():
+            self.totals.read()
+        if self.totals.state != self.state():
+            self.totals.rebuild(self.items())
+            self.totals.save(self.state())
+        return self.totals
+
+    def apply(self, records: list):
+        """
+        To append index mutations to the journal, they are durable once this returns
+        """
+        for record in records:
+            # checked before anything is written, a key that does not fit would stop every later compact
+            if record["op"] == "admit" and not _fits(record["key"]):
+                raise RuntimeError(f"The key {record['key']!r} can not be stored in a compact index, keys are up to {KEY_SIZE} ASCII characters.")
+        # other processes append to the same journal, so it is read and written under one lock
+        with journal_lock(self.journal_file):
+            self._open()
+            totals = self.aggregates()
+            changes = record_changes(self._current, records)
+            append_journal(self.journal_file, self.journal_offset, records)
+            self._open()
+            for old, new in changes:
+                totals.update(old, new)
+            totals.save(self.state())
+        if self.journal_offset > self.journal_limit:
+            self.compact()
+
+    def compact(self):
+        """
+        To fold the journal into a fresh index.bin and clear it, returns the number of entries
+        """
+        with journal_lock(self.journal_file):
+            return self._compact()
+
+    def _compact(self):
+        self._open()
+        in_sync = self.totals.state is not None and self.totals.state == self.state()
+        temp_file = f"{self.index_file}.new"
+        total = write_index(temp_file, self.items())
+        # the old map is closed before its file is replaced
+        self.close()
+        os.replace(temp_file, self.index_file)
+        with open(self.journal_file, "w") as journal:
+            journal.flush()
+            os.fsync(journal.fileno())
+        self.snapshot = None
+        self.overlay = {}
+        self.journal_offset = 0
+        if in_sync:
+            self.totals.save(self.state())
+        return total
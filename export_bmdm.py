@@ -0,0 +1,221 @@
+# libraries
+import os
+import io
+import json
+import time
+import itertools
+
+# archive formats 'export' can write, by the end of the target path
+ARCHIVE_SUFFIXES = (".zip", ".tar.gz", ".tgz", ".jsonl")
+
+class DirectoryWriter:
+    """
+    # Writes every exported entry as its own JSON file into an existing folder
+    * files are written by a pool of 'workers' threads, in batches so only a few entries wait in memory
+    """
+    def __init__(self, path: str, workers: int = 1):
+        self.path = path
+        self.workers = max(1, workers)
+        self.pool = None
+        if self.workers > 1:
+            from concurrent.futures import ThreadPoolExecutor
+            self.pool = ThreadPoolExecutor(self.workers)
+
+    def _write(self, item):
+        name, data = item
+        with open(os.path.join(self.path, name), "wb") as export_file:
+            export_file.write(data)
+
+    def write_all(self, items):
+        if self.pool is None:
+            for item in items:
+                self._write(item)
+            return
+        items = iter(items)
+        while True:
+            batch = list(itertools.islice(items, self.workers * 64))
+            if not batch:
+                break
+            # list() waits for the batch and raises the first write error
+            list(self.pool.map(self._write, batch))
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.shutdown()
+
+class ZipWriter:
+    """
+    # Writes the exported entries straight into one '.zip' archive
+    """
+    def __init__(self, path: str):
+        import zipfile
+        self.archive = zipfile.ZipFile(path, "w", compression=zipfile.ZIP_DEFLATED)
+
+    def write_all(self, items):
+        for name, data in items:
+            self.archive.writestr(name, data)
+
+    def close(self):
+        self.archive.close()
+
+class TarWriter:
+    """
+    # Writes the exported entries straight into one '.tar.gz' archive
+    """
+    def __init__(self, path: str):
+        import tarfile
+        self.tarfile = tarfile
+        self.archive = tarfile.open(path, "w:gz")
+
+    def write_all(self, items):
+        now = time.time()
+        for name, data in items:
+            info = self.tarfile.TarInfo(name)
+            info.size = len(data)
+            info.mtime = now
+            self.archive.addfile(info, io.BytesIO(data))
+
+    def close(self):
+        self.archive.close()
+
+class JsonlWriter:
+    """
+    # Writes the exported entries as one JSON Lines file, one entry per line
+    """
+    def __init__(self, path: str):
+        self.file = open(path, "wb")
+
+    def write_all(self, items):
+        for _, data in items:
+            self.file.write(data + b"\n")
+
+    def close(self):
+        self.file.close()
+
+def open_export(path: str, workers: int = 1):
+    """
+    To get the writer for an export target: a '.zip', '.tar.gz' / '.tgz' or '.jsonl' archive, otherwise a folder
+    """
+    if path.endswith(".zip"):
+        return ZipWriter(path)
+    if path.endswith((".tar.gz", ".tgz")):
+        return TarWriter(path)
+    if path.endswith(".jsonl"):
+        return JsonlWriter(path)
+    return DirectoryWriter(path, workers)
+
+def export_items(entries, jsonl: bool = False):
+    """
+    To turn (hash, entry) pairs into (file name, bytes) items, lazily
+    * an entry keeps its file name, a second entry with the same name is prefixed with its hash
+    * JSON Lines records are written on one line and carry the hash, files are indented like before
+    """
+    names = set()
+    for key, entry in entries:
+        entry = dict(entry)
+        name = entry["filename"]
+        if name in names:
+            name = f"{key}_{name}"
+        names.add(name)
+        if jsonl:
+            data = json.dumps({"hash": key, **entry}, ensure_ascii=False).encode("utf-8")
+        else:
+            data = json.dumps(entry, indent=4).encode("utf-8")
+        yield name, data
+
+# leading columns of 'export_table', other entry fields follow in name order and then one 'tag:<key>' column per tag key
+TABLE_FIELDS = ("hash", "filename", "patient_id", "study_date", "modality", "description", "path", "object")
+
+def table_columns(entries, tag_keys):
+    """
+    To get the columns of a table export: the fixed fields, every other field some entry has, the tags and 'removed'
+    """
+    extra = set()
+    for _, entry in entries:
+        extra.update(field for field in entry if field not in TABLE_FIELDS and field != "tags")
+    return list(TABLE_FIELDS) + sorted(extra) + [f"tag:{key}" for key in sorted(tag_keys)] + ["removed"]
+
+def table_row(key: str, entry, columns: list):
+    """
+    To flatten an entry into one row of text cells ('' when the entry has no value)
+    * the description word list is joined back with '_', other lists and dicts are written as JSON
+    """
+    tags = entry.get("tags", {})
+    row = []
+    for column in columns:
+        if column == "hash":
+            value = key
+        elif column == "removed":
+            value = False
+        elif column.startswith("tag:"):
+            value = tags.get(column[4:])
+        else:
+            value = entry.get(column)
+        if isinstance(value, list) and column == "description":
+            value = "_".join(str(part) for part in value)
+        elif isinstance(value, (list, dict)):
+            value = json.dumps(value, ensure_ascii=False)
+        row.append("" if value is None else str(value))
+    return row
+
+def entry_fingerprint(entry):
+    """
+    To get a short digest of an entry, an incremental export writes the entry again when it changes
+    """
+    import hashlib
+    return hashlib.blake2s(json.dumps(dict(entry), sort_keys=True, default=str).encode(), digest_size=8).hexdigest()
+
+class CsvTableWriter:
+    """
+    # Writes table rows into a CSV file with a header, or appends them to one with the same header
+    """
+    def __init__(self, path: str, columns: list, append: bool = False):
+        import csv
+        self.file = open(path, "a" if append else "w", encoding="utf-8", newline="")
+        self.writer = csv.writer(self.file)
+        if not append:
+            self.writer.writerow(columns)
+
+    def write_rows(self, rows: list):
+        self.writer.writerows(rows)
+
+    def close(self):
+        self.file.close()
+
+class ArrowTableWriter:
+    """
+    # Writes table rows into a Parquet ('.parquet') or Arrow IPC ('.arrow' / '.feather') file, one row group per chunk
+    * pyarrow is only needed (and imported) for these formats
+    """
+    def __init__(self, path: str, columns: list):
+        try:
+            import pyarrow
+        except ImportError:
+            raise RuntimeError("Parquet and Arrow exports need pyarrow ('pip install pyarrow'), or export to a .csv file.")
+        self.pyarrow = pyarrow
+        self.columns = columns
+        # every cell is text, like the CSV export
+        self.schema = pyarrow.schema([(column, pyarrow.string()) for column in columns])
+        if path.endswith(".parquet"):
+            import pyarrow.parquet
+            self.writer = pyarrow.parquet.ParquetWriter(path, self.schema)
+        else:
+            import pyarrow.ipc
+            self.writer = pyarrow.ipc.new_file(path, self.schema)
+
+    def write_rows(self, rows: list):
+        cells = {column: [row[i] for row in rows] for i, column in enumerate(self.columns)}
+        self.writer.write_table(self.pyarrow.Table.from_pydict(cells, schema=self.schema))
+
+    def close(self):
+        self.writer.close()
+
+def open_table(path: str, columns: list, append: bool = False):
+    """
+    To get the writer for a table export: Parquet / Arrow by the file ending, otherwise CSV
+    """
+    if path.endswith((".parquet", ".arrow", ".feather")):
+        if append:
+            raise RuntimeError("Only CSV table exports can be updated incrementally.")
+        return ArrowTableWriter(path, columns)
+    return CsvTableWriter(path, columns, append)
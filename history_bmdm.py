@@ -0,0 +1,324 @@
+# libraries
+import os
+import re
+import json
+import gzip
+import shutil
+import atexit
+import threading
+import time
+from collections import deque
+from datetime import datetime
+
+# rotation settings used when config.json has no "history" section
+DEFAULT_SETTINGS = {"max_bytes": 8 * 1024 * 1024, "daily": False, "compress": False, "format": "text"}
+
+def segment_dir(history_file: str):
+    """
+    To get the folder of rotated history segments
+    """
+    return os.path.join(os.path.dirname(history_file), "history")
+
+def load_segments(history_file: str):
+    """
+    To read the time index of rotated segments: [{"file", "first", "last", "records"}] from oldest to newest
+    """
+    index_file = os.path.join(segment_dir(history_file), "segments.json")
+    if not os.path.isfile(index_file):
+        return []
+    with open(index_file, "r") as i_f:
+        return json.load(i_f)
+
+def line_time(line: str):
+    """
+    To get the ISO timestamp a history line (text or JSON Lines) starts with
+    """
+    if line.startswith('{"timestamp": "'):
+        return line[15:line.find('"', 15)]
+    return line.split("|", 1)[0]
+
+def reverse_lines(path: str, block_size: int = 64 * 1024):
+    """
+    To yield the lines of a file from the last to the first, reading it backwards block by block
+    """
+    with open(path, "rb") as f:
+        f.seek(0, os.SEEK_END)
+        position = f.tell()
+        rest = b""
+        while position > 0:
+            size = min(block_size, position)
+            position -= size
+            f.seek(position)
+            lines = (f.read(size) + rest).split(b"\n")
+            # the first piece may be the end of a line that starts in the previous block
+            rest = lines.pop(0)
+            for line in reversed(lines):
+                if line:
+                    yield line.decode("utf-8", errors="replace") + "\n"
+        if rest:
+            yield rest.decode("utf-8", errors="replace") + "\n"
+
+def parse_line(line: str):
+    """
+    To turn a history line (text or JSON Lines) into a record: timestamp, command, activity, details, user, targets
+    """
+    if line.startswith("{"):
+        try:
+            return json.loads(line)
+        except ValueError:
+            pass
+    parts = line.rstrip("\n").split("|")
+    record = {"timestamp": parts[0], "command": "", "activity": "", "details": "", "user": {}, "targets": []}
+    if len(parts) >= 4:
+        record["command"] = parts[1].replace("command: ", "", 1)
+        # details may contain '|' themselves, the user is always the last field
+        record["activity"], _, record["details"] = "|".join(parts[2:-1]).partition(": ")
+        user = re.search(r"'name': '(.*)', 'email': '(.*)'", parts[-1])
+        if user:
+            record["user"] = {"name": user.group(1), "email": user.group(2)}
+    return record
+
+def record_filter(command: str = None, activity: str = None, user: str = None, target: str = None):
+    """
+    To build a predicate over history lines for 'read_recent', None when there is nothing to filter
+    * 'user' matches the name or the email, 'target' matches a target id (or the details of older text lines)
+    """
+    if not (command or activity or user or target):
+        return None
+    def where(line):
+        # lines that can not match are dropped before they are parsed
+        if any(value and value not in line for value in (command, activity, user, target)):
+            return False
+        record = parse_line(line)
+        if command and record.get("command") != command:
+            return False
+        if activity and record.get("activity") != activity:
+            return False
+        if user and user not in ((record.get("user") or {}).get("name"), (record.get("user") or {}).get("email")):
+            return False
+        if target and target not in record.get("targets", []) and target not in record.get("details", ""):
+            return False
+        return True
+    return where
+
+def read_recent(history_file: str, number=None, since: str = None, until: str = None, where=None):
+    """
+    To get up to 'number' history lines (all if None), newest first, optionally within [since, until]
+    * the active log is read backwards from its end, older segments only when more lines are needed
+    * segments whose time index is entirely outside [since, until] are not opened
+    * 'since' / 'until' are ISO timestamps or prefixes of one ('2024-05', '2024-05-01T10'), both inclusive
+    * 'where' is an optional predicate on the line (see 'record_filter')
+    """
+    def wanted(line):
+        timestamp = line_time(line)
+        if since and timestamp < since:
+            return False
+        if until and timestamp[:len(until)] > until:
+            return False
+        return where is None or where(line)
+
+    lines = []
+    sources = [None] + list(reversed(load_segments(history_file)))
+    for segment in sources:
+        remaining = None if number is None else number - len(lines)
+        if remaining == 0:
+            break
+        if segment is None:
+            if not os.path.isfile(history_file):
+                continue
+            path = history_file
+        else:
+            if since and segment["last"] < since:
+                # every older segment is older still
+                break
+            if until and segment["first"][:len(until)] > until:
+                continue
+            path = os.path.join(segment_dir(history_file), segment["file"])
+        if path.endswith(".gz"):
+            # a gzip segment can only be read forwards, so just the newest 'remaining' matches are kept
+            with gzip.open(path, "rt", encoding="utf-8", errors="replace") as f:
+                found = deque((line for line in f if wanted(line)), maxlen=remaining)
+            lines.extend(reversed(found))
+        else:
+            for line in reverse_lines(path):
+                if wanted(line):
+                    lines.append(line)
+                    if number is not None and len(lines) >= number:
+                        break
+    return lines
+
+class HistoryWriter:
+    """
+    # Buffered writer for 'history.log'
+    * the manager identity is read from config.json once and cached until the file changes
+    * records are written in batches: when 'max_records' are waiting, when the oldest one is 'max_delay' seconds old, and at exit
+    * the active log is rotated into '.bmdm/history/' by size or by day (config.json "history" section), optionally gzipped
+    * with "format": "jsonl" records are written as JSON Lines (timestamp, command, activity, details, user, targets)
+    * Method 'start_flusher': to flush from a background thread, so logging never waits for the disk
+    """
+    def __init__(self, history_file: str, config_file: str, max_records: int = 256, max_delay: float = 1.0):
+        self.history_file = history_file
+        self.config_file = config_file
+        self.max_records = max_records
+        self.max_delay = max_delay
+        self.buffer = []
+        self.first_time = None
+        self.user = None
+        self.manager = None
+        self.settings = dict(DEFAULT_SETTINGS)
+        self.config_signature = None
+        # timestamp of the first line in the active log, for daily rotation
+        self.active_first = None
+        self.lock = threading.RLock()
+        self.file_lock = threading.RLock()
+        self.wake = threading.Event()
+        self.flusher = None
+        atexit.register(self.flush)
+
+    def identity(self):
+        """
+        To get the manager part of a log line, re-read only when config.json changed
+        """
+        try:
+            stat = os.stat(self.config_file)
+            signature = (stat.st_mtime_ns, stat.st_size)
+        except FileNotFoundError:
+            signature = None
+        if self.user is None or signature != self.config_signature:
+            with open(self.config_file, "r") as c_f:
+                config_file = json.load(c_f)
+            # only the manager part names the user, other sections are settings
+            self.manager = config_file["manager"]
+            self.user = str({"manager": self.manager}).replace('{', '').replace('}', '').replace("'manager':", '')
+            self.settings = dict(DEFAULT_SETTINGS, **config_file.get("history", {}))
+            self.config_signature = signature
+        return self.user
+
+    def invalidate(self):
+        """
+        To forget the cached identity (after config.json was written)
+        """
+        with self.lock:
+            self.user = None
+
+    def write(self, method, activity_type, details, targets: list = None):
+        """
+        To add a record to the buffer, it is written to the file with the next flush
+        """
+        with self.lock:
+            timestamp = datetime.now().isoformat()
+            user = self.identity()
+            if self.settings.get("format") == "jsonl":
+                record = {
+                    "timestamp": timestamp,
+                    "command": method,
+                    "activity": activity_type,
+                    "details": str(details),
+                    "user": self.manager,
+                    "targets": [str(target) for target in targets or []]
+                }
+                self.buffer.append(json.dumps(record, ensure_ascii=False) + "\n")
+            else:
+                self.buffer.append(f"{timestamp}|command: {method}|{activity_type}: {details}|{user}\n")
+            if self.first_time is None:
+                self.first_time = time.monotonic()
+            due = len(self.buffer) >= self.max_records or time.monotonic() - self.first_time >= self.max_delay
+        if due:
+            # with a flusher thread the write is handed over, otherwise it is done here
+            if self.flusher is not None:
+                self.wake.set()
+            else:
+                self.flush()
+
+    def flush(self):
+        """
+        To append all buffered records to the history file in one write
+        """
+        # the file lock keeps batches in order, the buffer lock is only held for the swap
+        with self.file_lock:
+            with self.lock:
+                if not self.buffer:
+                    return
+                lines = self.buffer
+                self.buffer = []
+                self.first_time = None
+            # nothing can be logged before boot created the folder
+            if not os.path.isdir(os.path.dirname(self.history_file) or "."):
+                return
+            data = "".join(lines)
+            if self._should_rotate(len(data), line_time(lines[0])):
+                self.rotate()
+            with open(self.history_file, 'a') as f:
+                f.write(data)
+            if self.active_first is None:
+                self.active_first = line_time(lines[0])
+
+    def _should_rotate(self, incoming: int, timestamp: str):
+        """
+        True if the active log is over the size limit or (with daily rotation) holds an older day
+        """
+        if not os.path.isfile(self.history_file) or os.path.getsize(self.history_file) == 0:
+            return False
+        max_bytes = self.settings.get("max_bytes")
+        if max_bytes and os.path.getsize(self.history_file) + incoming > max_bytes:
+            return True
+        if self.settings.get("daily"):
+            if self.active_first is None:
+                with open(self.history_file, "r") as f:
+                    self.active_first = line_time(f.readline())
+            return self.active_first[:10] != timestamp[:10]
+        return False
+
+    def rotate(self):
+        """
+        To move the active log into a new segment and record its time range in 'segments.json'
+        """
+        with self.file_lock:
+            if not os.path.isfile(self.history_file) or os.path.getsize(self.history_file) == 0:
+                return
+            folder = segment_dir(self.history_file)
+            os.makedirs(folder, exist_ok=True)
+            # one pass over the closed log gives its time range and size
+            first = last = None
+            records = 0
+            with open(self.history_file, "r", errors="replace") as f:
+                for line in f:
+                    timestamp = line_time(line)
+                    first = timestamp if first is None or timestamp < first else first
+                    last = timestamp if last is None or timestamp > last else last
+                    records += 1
+            name = "history-" + first.replace(":", "").replace("-", "").split(".")[0]
+            number = 0
+            while any(os.path.exists(os.path.join(folder, f"{name}{suffix}")) for suffix in (".log", ".log.gz")):
+                number += 1
+                name = f"{name.split('_')[0]}_{number}"
+            file_name = f"{name}.log"
+            os.replace(self.history_file, os.path.join(folder, file_name))
+            if self.settings.get("compress"):
+                with open(os.path.join(folder, file_name), "rb") as source, gzip.open(os.path.join(folder, file_name + ".gz"), "wb") as target:
+                    shutil.copyfileobj(source, target)
+                os.remove(os.path.join(folder, file_name))
+                file_name += ".gz"
+            segments = load_segments(self.history_file)
+            segments.append({"file": file_name, "first": first, "last": last, "records": records})
+            temp_file = os.path.join(folder, "segments.json.tmp")
+            with open(temp_file, "w") as i_f:
+                json.dump(segments, i_f, indent=4)
+            os.replace(temp_file, os.path.join(folder, "segments.json"))
+            self.active_first = None
+
+    def start_flusher(self):
+        """
+        To start a daemon thread that flushes the buffer every 'max_delay' seconds (or sooner when it is full)
+        """
+        with self.lock:
+            if self.flusher is not None:
+                return
+            self.flusher = threading.Thread(target=self._flush_loop, name="bmdm-history", daemon=True)
+            self.flusher.start()
+
+    def _flush_loop(self):
+        while True:
+            self.wake.wait(self.max_delay)
+            self.wake.clear()
+            self.flush()
@@ -0,0 +1,58 @@
+"""
+Cold-start regression check for the CLI
+* imports 'bmdm' under 'python -X importtime' a few times and keeps the fastest run
+* fails when tkinter is imported or the import takes longer than the budget
+usage: python importtime_check.py [budget_ms]
+"""
+# libraries
+import os
+import sys
+import subprocess
+
+# budget for 'import bmdm' (milliseconds), the headless CLI path must stay under it
+BUDGET_MS = 150
+RUNS = 5
+# modules that only the GUI may load
+GUI_MODULES = ("tkinter", "_tkinter", "GUI_bmdm")
+
+def measure():
+    """
+    To import bmdm once in a fresh interpreter, returns (cumulative time in ms, imported module names)
+    """
+    completed = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import bmdm"],
+        capture_output=True, text=True, cwd=os.path.dirname(os.path.abspath(__file__))
+    )
+    if completed.returncode != 0:
+        raise RuntimeError(completed.stderr)
+    total = None
+    modules = []
+    for line in completed.stderr.splitlines():
+        if not line.startswith("import time:"):
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        # the header line has no numbers
+        if not cumulative.strip().isdigit():
+            continue
+        modules.append(name.strip())
+        if name.strip() == "bmdm":
+            total = int(cumulative) / 1000
+    return total, modules
+
+def main():
+    budget = float(sys.argv[1]) if len(sys.argv) > 1 else BUDGET_MS
+    runs = [measure() for _ in range(RUNS)]
+    best = min(total for total, _ in runs)
+    gui = sorted({module for _, modules in runs for module in modules if module.split(".")[0] in GUI_MODULES})
+    print(f"import bmdm: {best:.1f} ms (budget {budget:.0f} ms, best of {RUNS})")
+    failed = False
+    if gui:
+        print(f"[ERROR] GUI modules are imported on the CLI path: {', '.join(gui)}")
+        failed = True
+    if best > budget:
+        print(f"[ERROR] import bmdm took {best:.1f} ms, over the {budget:.0f} ms budget")
+        failed = True
+    sys.exit(1 if failed else 0)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,283 @@
+# libraries
+import os
+import io
+import struct
+import hashlib
+
+# files are read and hashed in chunks of this size, so large payloads are never held in memory
+CHUNK_SIZE = 1024 * 1024
+# a new pack file is started once the current one reaches this size (bytes)
+PACK_LIMIT = 256 * 1024 * 1024
+# pack index: a header (magic, version, count) and one record per object (digest, pack number, offset, length) sorted by digest
+INDEX_HEADER = struct.Struct("<4sII")
+INDEX_RECORD = struct.Struct("<32sIQQ")
+INDEX_MAGIC = b"BMPI"
+
+def hash_file(source: str):
+    """
+    To get the hash a file would be stored under by 'ObjectStore.put', without storing it
+    """
+    digest = hashlib.blake2s()
+    with open(source, "rb") as s_f:
+        for chunk in iter(lambda: s_f.read(CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+class ObjectStore:
+    """
+    # Content-addressed store for the admitted files in '.bmdm/objects'
+    * an object is named by the blake2s hash of its bytes and kept in 'objects/ab/cd/<hash>'
+    * identical payloads are stored once, whatever their file names
+    * 'repack' moves loose objects into large append-only pack files ('objects/pack/pack-N.pack') with a binary offset index
+    * Method 'put': to copy a file into the store, returns its hash
+    * Method 'read' / 'open': to read an object back, packed objects through mmap
+    * Method 'gc': to delete the objects no entry refers to
+    * Method 'repack': to pack all loose objects that are still referred to
+    """
+    def __init__(self, objects_dir: str = ".bmdm/objects"):
+        self.objects_dir = objects_dir
+        self.pack_dir = os.path.join(objects_dir, "pack")
+        self.index_file = os.path.join(self.pack_dir, "packs.idx")
+        # opened on first use: the pack index and the pack files, both memory-mapped
+        self.index = None
+        self.maps = {}
+
+    def path(self, hash: str):
+        """
+        To get the sharded path of a loose object
+        """
+        return os.path.join(self.objects_dir, hash[:2], hash[2:4], hash)
+
+    def contains(self, hash: str):
+        return os.path.isfile(self.path(hash)) or self._locate(hash) is not None
+
+    def put(self, source: str):
+        """
+        To hash and copy a file in one pass, an object that is already stored (loose or packed) is not written again
+        """
+        temp_dir = os.path.join(self.objects_dir, "tmp")
+        os.makedirs(temp_dir, exist_ok=True)
+        # the temp name is unique per process, so parallel admits do not share it
+        temp_file = os.path.join(temp_dir, f"{os.getpid()}-{os.path.basename(source)}")
+        digest = hashlib.blake2s()
+        try:
+            with open(source, "rb") as s_f, open(temp_file, "wb") as t_f:
+                for chunk in iter(lambda: s_f.read(CHUNK_SIZE), b""):
+                    digest.update(chunk)
+                    t_f.write(chunk)
+            hash = digest.hexdigest()
+            target = self.path(hash)
+            if self.contains(hash):
+                os.remove(temp_file)
+            else:
+                os.makedirs(os.path.dirname(target), exist_ok=True)
+                # the object appears complete or not at all
+                os.replace(temp_file, target)
+        except BaseException:
+            if os.path.exists(temp_file):
+                os.remove(temp_file)
+            raise
+        return hash
+
+    def read(self, hash: str):
+        """
+        To get the bytes of an object, for a packed one only its own bytes are read from the pack
+        """
+        if os.path.isfile(self.path(hash)):
+            with open(self.path(hash), "rb") as f:
+                return f.read()
+        location = self._locate(hash)
+        if location is None:
+            raise FileNotFoundError(f"Object {hash} is not in the store.")
+        pack, offset, length = location
+        return self._pack_map(pack)[offset:offset + length]
+
+    def open(self, hash: str):
+        """
+        To open a stored object for reading (binary)
+        """
+        if os.path.isfile(self.path(hash)):
+            return open(self.path(hash), "rb")
+        return io.BytesIO(self.read(hash))
+
+    def close(self):
+        for mapped in self.maps.values():
+            mapped.close()
+        self.maps = {}
+        if self.index is not None:
+            self.index.close()
+            self.index = None
+
+    def _pack_file(self, pack: int):
+        return os.path.join(self.pack_dir, f"pack-{pack}.pack")
+
+    def _pack_map(self, pack: int):
+        import mmap
+        if pack not in self.maps:
+            with open(self._pack_file(pack), "rb") as f:
+                self.maps[pack] = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return self.maps[pack]
+
+    def _index_count(self):
+        """
+        To open the pack index, returns the number of packed objects (0 if nothing was packed yet)
+        """
+        import mmap
+        if self.index is None:
+            if not os.path.isfile(self.index_file) or os.path.getsize(self.index_file) <= INDEX_HEADER.size:
+                return 0
+            with open(self.index_file, "rb") as f:
+                self.index = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            magic, version, _ = INDEX_HEADER.unpack_from(self.index, 0)
+            if magic != INDEX_MAGIC or version != 1:
+                raise RuntimeError(f"{self.index_file} is not a pack index.")
+        return INDEX_HEADER.unpack_from(self.index, 0)[2]
+
+    def _record(self, i: int):
+        return INDEX_RECORD.unpack_from(self.index, INDEX_HEADER.size + i * INDEX_RECORD.size)
+
+    def _locate(self, hash: str):
+        """
+        To find (pack, offset, length) of a packed object with a binary search over the index, None if it is not packed
+        """
+        count = self._index_count()
+        if not count:
+            return None
+        digest = bytes.fromhex(hash)
+        low, high = 0, count
+        while low < high:
+            middle = (low + high) // 2
+            if self._record(middle)[0] < digest:
+                low = middle + 1
+            else:
+                high = middle
+        if low < count:
+            record = self._record(low)
+            if record[0] == digest:
+                return record[1:]
+        return None
+
+    def _packed(self):
+        """
+        To iterate over the (hash, pack, offset, length) of all packed objects
+        """
+        for i in range(self._index_count()):
+            digest, pack, offset, length = self._record(i)
+            yield digest.hex(), pack, offset, length
+
+    def _loose(self):
+        """
+        To iterate over the hashes of all loose objects
+        """
+        for first in os.listdir(self.objects_dir):
+            if len(first) != 2 or not os.path.isdir(os.path.join(self.objects_dir, first)):
+                continue
+            for second in os.listdir(os.path.join(self.objects_dir, first)):
+                folder = os.path.join(self.objects_dir, first, second)
+                if os.path.isdir(folder):
+                    yield from os.listdir(folder)
+
+    def _remove_loose(self, hash: str):
+        os.remove(self.path(hash))
+        # empty shard folders are removed too
+        for folder in (os.path.dirname(self.path(hash)), os.path.dirname(os.path.dirname(self.path(hash)))):
+            try:
+                os.rmdir(folder)
+            except OSError:
+                break
+
+    def gc(self, keep: set):
+        """
+        To delete loose and packed objects whose hash is not in 'keep', returns the number deleted
+        * packs are only rewritten when they hold an orphaned object
+        """
+        removed = 0
+        for hash in list(self._loose()):
+            if hash not in keep:
+                self._remove_loose(hash)
+                removed += 1
+        packed = list(self._packed())
+        kept = [record for record in packed if record[0] in keep]
+        if len(kept) < len(packed):
+            self._write_packs(kept, [])
+            removed += len(packed) - len(kept)
+        return removed
+
+    def repack(self, keep: set):
+        """
+        To move every referenced loose object into new pack files and drop orphaned objects, returns (packed, removed)
+        """
+        loose = list(self._loose())
+        packed = list(self._packed())
+        kept = [record for record in packed if record[0] in keep]
+        known = {record[0] for record in kept}
+        # a loose copy of an object that is already packed is just deleted
+        to_pack = [hash for hash in loose if hash in keep and hash not in known]
+        self._write_packs(kept, to_pack)
+        for hash in loose:
+            self._remove_loose(hash)
+        removed = len(packed) - len(kept) + sum(1 for hash in loose if hash not in keep)
+        return len(kept) + len(to_pack), removed
+
+    def _write_packs(self, packed: list, loose: list):
+        """
+        To write packed records and loose objects into new packs, switch the index to them and delete the old packs
+        * the old packs stay valid until the new index is in place, so a crash never loses an object
+        """
+        os.makedirs(self.pack_dir, exist_ok=True)
+        old_packs = {record[1] for record in self._packed()} | set(self._pack_numbers())
+        pack = max(old_packs, default=0) + 1
+        records = []
+        out = None
+        try:
+            def target(length):
+                # a new pack is started when the current one would grow past the limit
+                nonlocal pack, out
+                if out is not None and out.tell() and out.tell() + length > PACK_LIMIT:
+                    out.flush()
+                    os.fsync(out.fileno())
+                    out.close()
+                    out = None
+                    pack += 1
+                if out is None:
+                    out = open(self._pack_file(pack), "wb")
+                return out
+            for hash, source_pack, offset, length in packed:
+                f = target(length)
+                records.append((bytes.fromhex(hash), pack, f.tell(), length))
+                f.write(self._pack_map(source_pack)[offset:offset + length])
+            for hash in loose:
+                length = os.path.getsize(self.path(hash))
+                f = target(length)
+                records.append((bytes.fromhex(hash), pack, f.tell(), length))
+                with open(self.path(hash), "rb") as source:
+                    for chunk in iter(lambda: source.read(CHUNK_SIZE), b""):
+                        f.write(chunk)
+            if out is not None:
+                out.flush()
+                os.fsync(out.fileno())
+        finally:
+            if out is not None:
+                out.close()
+        records.sort()
+        temp_file = f"{self.index_file}.tmp"
+        with open(temp_file, "wb") as i_f:
+            i_f.write(INDEX_HEADER.pack(INDEX_MAGIC, 1, len(records)))
+            for record in records:
+                i_f.write(INDEX_RECORD.pack(*record))
+            i_f.flush()
+            os.fsync(i_f.fileno())
+        # the old maps must be closed before their files are replaced or deleted
+        self.close()
+        os.replace(temp_file, self.index_file)
+        for number in old_packs:
+            if os.path.exists(self._pack_file(number)):
+                os.remove(self._pack_file(number))
+
+    def _pack_numbers(self):
+        """
+        To list the numbers of the pack files on disk (including ones a crashed repack left behind)
+        """
+        if not os.path.isdir(self.pack_dir):
+            return []
+        return [int(name[5:-5]) for name in os.listdir(self.pack_dir) if name.startswith("pack-") and name.endswith(".pack")]
@@ -0,0 +1,247 @@
+"""
+Query expressions for 'find', e.g.  modality in (CT,MR) and tag:site=lung and not patient_id~^TEST
+* comparisons: field = v, field != v, field in (v1, v2), field ^= prefix, field ~ regex, field < <= > >= v
+* fields are entry fields (patient_id, modality, study_date, filename, description, ...), 'hash' is the entry key
+  and 'tag:key' a tag value ('tag:key' alone: the entry has this tag)
+* study_date comparisons use the normalised YYYYMMDD date, values may be quoted with ' or "
+* terms are combined with 'and', 'or', 'not' and parentheses
+"""
+# libraries
+import re
+from storage_bmdm import date_key
+
+# fields the index stores can look up directly
+INDEXED = ("filename", "patient_id", "study_date", "modality")
+KEYWORDS = ("and", "or", "not", "in")
+TOKEN = re.compile(r"""\s*(?:(\(|\)|,)|(!=|\^=|<=|>=|=|<|>|~)|'((?:[^'\\]|\\.)*)'|"((?:[^"\\]|\\.)*)"|((?:[^\s()=!<>~,'"^]|\^(?!=))+))""")
+
+def tokenize(text: str):
+    """
+    To split a query into (kind, value) tokens: 'punct', 'op', 'word' or 'string'
+    """
+    tokens = []
+    position = 0
+    text = text.strip()
+    while position < len(text):
+        match = TOKEN.match(text, position)
+        if not match or match.end() == position:
+            raise RuntimeError(f"Invalid query: unexpected '{text[position:].strip()[:20]}'.")
+        punct, op, single, double, word = match.groups()
+        if punct:
+            tokens.append(("punct", punct))
+        elif op:
+            tokens.append(("op", op))
+        elif single is not None or double is not None:
+            tokens.append(("string", re.sub(r"\\(.)", r"\1", single if single is not None else double)))
+        else:
+            tokens.append(("word", word))
+        position = match.end()
+    return tokens
+
+class Parser:
+    """
+    # Recursive descent parser: or_expr -> and_expr ('or' and_expr)* -> not_expr ('and' not_expr)* -> 'not' not_expr | term
+    * the result is a tree of tuples: ('and', [..]), ('or', [..]), ('not', node), ('cmp', field, op, value)
+    """
+    def __init__(self, text: str):
+        self.tokens = tokenize(text)
+        self.position = 0
+
+    def peek(self):
+        return self.tokens[self.position] if self.position < len(self.tokens) else (None, None)
+
+    def next(self):
+        token = self.peek()
+        if token[0] is None:
+            raise RuntimeError("Invalid query: it ends too early.")
+        self.position += 1
+        return token
+
+    def keyword(self, word: str):
+        kind, value = self.peek()
+        if kind == "word" and value.lower() == word:
+            self.position += 1
+            return True
+        return False
+
+    def parse(self):
+        if not self.tokens:
+            raise RuntimeError("Invalid query: it is empty.")
+        node = self.or_expr()
+        if self.position < len(self.tokens):
+            raise RuntimeError(f"Invalid query: unexpected '{self.peek()[1]}'.")
+        return node
+
+    def or_expr(self):
+        nodes = [self.and_expr()]
+        while self.keyword("or"):
+            nodes.append(self.and_expr())
+        return nodes[0] if len(nodes) == 1 else ("or", nodes)
+
+    def and_expr(self):
+        nodes = [self.not_expr()]
+        while self.keyword("and"):
+            nodes.append(self.not_expr())
+        return nodes[0] if len(nodes) == 1 else ("and", nodes)
+
+    def not_expr(self):
+        if self.keyword("not"):
+            return ("not", self.not_expr())
+        return self.term()
+
+    def value(self):
+        kind, value = self.next()
+        if kind not in ("word", "string"):
+            raise RuntimeError(f"Invalid query: a value was expected, not '{value}'.")
+        return value
+
+    def term(self):
+        kind, value = self.peek()
+        if kind == "punct" and value == "(":
+            self.position += 1
+            node = self.or_expr()
+            if self.next() != ("punct", ")"):
+                raise RuntimeError("Invalid query: ')' is missing.")
+            return node
+        kind, field = self.next()
+        if kind != "word" or field.lower() in KEYWORDS:
+            raise RuntimeError(f"Invalid query: a field was expected, not '{field}'.")
+        if self.keyword("in"):
+            if self.next() != ("punct", "("):
+                raise RuntimeError("Invalid query: 'in' needs a list like (CT, MR).")
+            values = [self.value()]
+            while self.peek() == ("punct", ","):
+                self.position += 1
+                values.append(self.value())
+            if self.next() != ("punct", ")"):
+                raise RuntimeError("Invalid query: ')' is missing.")
+            return ("cmp", field, "in", values)
+        kind, op = self.peek()
+        if kind != "op":
+            if field.startswith("tag:"):
+                # a bare tag term only asks for the key
+                return ("cmp", field, "has", None)
+            raise RuntimeError(f"Invalid query: an operator was expected after '{field}'.")
+        self.position += 1
+        value = self.value()
+        if op == "~":
+            try:
+                value = re.compile(value)
+            except re.error as e:
+                raise RuntimeError(f"Invalid query: bad regular expression '{value}' ({e}).")
+        return ("cmp", field, op, value)
+
+def field_value(key: str, entry, field: str):
+    """
+    To get the value a query field refers to, None if the entry does not have it
+    """
+    if field == "hash":
+        return key
+    if field.startswith("tag:"):
+        return entry.get("tags", {}).get(field[4:])
+    value = entry.get(field)
+    if isinstance(value, list):
+        # the description of a txt file is a list of words
+        return "_".join(str(part) for part in value)
+    return value
+
+def compile_node(node):
+    """
+    To turn a parsed query into a predicate(key, entry) -> bool, built once and called per entry
+    """
+    kind = node[0]
+    if kind == "and":
+        parts = [compile_node(part) for part in node[1]]
+        return lambda key, entry: all(part(key, entry) for part in parts)
+    if kind == "or":
+        parts = [compile_node(part) for part in node[1]]
+        return lambda key, entry: any(part(key, entry) for part in parts)
+    if kind == "not":
+        part = compile_node(node[1])
+        return lambda key, entry: not part(key, entry)
+    _, field, op, value = node
+    dated = field == "study_date" and op in ("<", "<=", ">", ">=")
+    if dated:
+        # dates are compared as YYYYMMDD, whatever separators they were written with
+        value = date_key(value) or value
+    def get(key, entry):
+        found = field_value(key, entry, field)
+        if found is None:
+            return None
+        return (date_key(found) if dated else None) or str(found)
+    if op == "has":
+        return lambda key, entry: get(key, entry) is not None
+    if op == "=":
+        return lambda key, entry: get(key, entry) == value
+    if op == "!=":
+        return lambda key, entry: get(key, entry) != value
+    if op == "in":
+        values = set(value)
+        return lambda key, entry: get(key, entry) in values
+    if op == "^=":
+        test = lambda found: found.startswith(value)
+    elif op == "~":
+        test = lambda found: value.search(found) is not None
+    else:
+        test = {"<": lambda found: found < value, "<=": lambda found: found <= value,
+                ">": lambda found: found > value, ">=": lambda found: found >= value}[op]
+    # entries without the field never match an ordering, prefix or regex term
+    def check(key, entry):
+        found = get(key, entry)
+        return found is not None and test(found)
+    return check
+
+class QueryPlan:
+    """
+    # A parsed query: the index lookups that narrow it down and the predicate that decides
+    * Attribute 'lookups': list of filter dicts for the store's 'iter_query', their union holds every match
+    * Attribute 'exact': True if the lookups alone give exactly the matches (no predicate needed)
+    * Method 'matches': to check one entry against the whole query
+    """
+    def __init__(self, text: str):
+        self.text = text
+        self.tree = Parser(text).parse()
+        self.matches = compile_node(self.tree)
+        self.lookups, self.exact = self._plan(self.tree)
+
+    @staticmethod
+    def _plan(tree):
+        """
+        To pick index lookups from the terms every match must satisfy (the top-level 'and')
+        """
+        terms = tree[1] if tree[0] == "and" else [tree]
+        filters = {}
+        low = high = None
+        choices = None
+        used = 0
+        for term in terms:
+            if term[0] != "cmp":
+                continue
+            _, field, op, value = term
+            if op == "=" and field in INDEXED and field not in filters:
+                filters[field] = value
+                used += 1
+            elif op == "=" and field.startswith("tag:") and "tag" not in filters:
+                filters["tag"] = f"{field[4:]}={value}"
+                used += 1
+            elif field == "study_date" and op in ("<=", ">=") and date_key(value):
+                if op == ">=":
+                    low = max(low or "", date_key(value))
+                else:
+                    high = min(high or "99999999", date_key(value))
+                used += 1
+            elif op == "in" and field in INDEXED and choices is None:
+                choices = (field, value)
+        if (low or high) and "study_date" not in filters:
+            filters["study_date"] = (low, high)
+        if choices and choices[0] not in filters:
+            # one lookup per listed value, their results do not overlap
+            lookups = [dict(filters, **{choices[0]: value}) for value in dict.fromkeys(choices[1])]
+            return lookups, used + 1 == len(terms)
+        return [filters], used == len(terms)
+
+def parse_query(text: str):
+    """
+    To parse a query expression into a 'QueryPlan'
+    """
+    return QueryPlan(text)
@@ -0,0 +1,215 @@
+# libraries
+import os
+import json
+import builtins
+from BioMedDataManager import console_prompt
+
+# commands that a running daemon answers, everything else always runs directly
+SERVED_COMMANDS = ("find", "find_count", "tag", "tag_many", "admit", "stats", "export", "export_table", "remove")
+# served commands that return a generator, their results are sent back one line per item
+SERVED_STREAMS = ("iter_find",)
+# maintenance commands that rewrite the index or the object store, refused while a daemon holds them
+EXCLUSIVE_COMMANDS = ("compact", "migrate", "gc", "repack")
+# returned by 'request' when no daemon is listening
+NOT_RUNNING = object()
+
+def serve(manager, host: str = "127.0.0.1", port: int = 0):
+    """
+    To keep one BioMedDataManager (and its index) in memory and answer CLI calls over a local TCP socket
+    * the address and an access token are written to '.bmdm/server.json' for clients to find
+    * requests are handled one at a time, so the daemon is the only writer while it runs
+    """
+    import socketserver
+    import signal
+    import secrets
+
+    if not os.path.isdir(manager.bmdm_dir):
+        raise RuntimeError("First you need to load the boot, run 'python bmdm.py boot' first")
+    token = secrets.token_hex(16)
+    server_file = f"{manager.bmdm_dir}/server.json"
+
+    class Handler(socketserver.StreamRequestHandler):
+        def handle(self):
+            try:
+                message = json.loads(self.rfile.readline())
+            except ValueError:
+                return
+            if message.get("token") != token:
+                reply = {"ok": False, "type": "PermissionError", "error": "Invalid daemon token."}
+            elif message.get("command") in SERVED_STREAMS:
+                try:
+                    for reply in handle_stream(manager, message["command"], message.get("kwargs", {})):
+                        self.wfile.write((json.dumps(reply) + "\n").encode())
+                except (BrokenPipeError, ConnectionResetError):
+                    # the client stopped reading (e.g. piped into 'head')
+                    pass
+                return
+            else:
+                reply = handle_request(manager, message.get("command"), message.get("kwargs", {}))
+            self.wfile.write((json.dumps(reply) + "\n").encode())
+
+    def stop(signum, frame):
+        raise KeyboardInterrupt
+
+    # a plain 'kill' stops the daemon as cleanly as Ctrl+C
+    signal.signal(signal.SIGTERM, stop)
+    # requests never wait for history writes, they are flushed in the background
+    manager._history_writer().start_flusher()
+    with socketserver.TCPServer((host, port), Handler) as server:
+        host, port = server.server_address
+        # the file holds the token, so only the owner may read it
+        descriptor = os.open(server_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(descriptor, "w") as s_f:
+            json.dump({"host": host, "port": port, "pid": os.getpid(), "token": token}, s_f)
+        manager._log_activity('serve', "SERVE", f"Daemon listening on {host}:{port}")
+        print(f"BMDM daemon listening on {host}:{port} (Ctrl+C to stop)")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            if os.path.exists(server_file):
+                os.remove(server_file)
+            manager._log_activity('serve', "SERVE", "Daemon stopped")
+
+def handle_request(manager, command: str, kwargs: dict):
+    """
+    To run one served command on the daemon's manager and wrap the result or the error in a reply
+    """
+    if command not in SERVED_COMMANDS:
+        return {"ok": False, "type": "RuntimeError", "error": f"The daemon does not serve '{command}'."}
+    try:
+        if command == "tag" and not kwargs.get("remove") and kwargs.get("overwrite") is None:
+            # the daemon can not prompt, so an existing key is sent back to the client to confirm
+            targets = manager._find_tag_targets(kwargs["id_filename"])
+            if any(kwargs["key"] in entry["tags"] for _, entry in targets):
+                return {"ok": False, "confirm": "A tag with this key already exists.\nAre you sure you want to change it(yes,no)? "}
+            kwargs["overwrite"] = True
+        return {"ok": True, "result": getattr(manager, command)(**kwargs)}
+    except Exception as e:
+        return {"ok": False, "type": type(e).__name__, "error": str(e)}
+
+def handle_stream(manager, command: str, kwargs: dict):
+    """
+    To run a served generator command and yield one reply per item, then an end (or error) reply
+    """
+    try:
+        for item in getattr(manager, command)(**kwargs):
+            yield {"item": item}
+    except Exception as e:
+        yield {"ok": False, "type": type(e).__name__, "error": str(e)}
+        return
+    yield {"ok": True, "end": True}
+
+def _send(command: str, kwargs: dict, bmdm_dir: str):
+    """
+    To send a command to the running daemon, returns the open connection or 'NOT_RUNNING' when there is none
+    """
+    server_file = f"{bmdm_dir}/server.json"
+    if not os.path.isfile(server_file):
+        return NOT_RUNNING
+    import socket
+    try:
+        with open(server_file, "r") as s_f:
+            server = json.load(s_f)
+        connection = socket.create_connection((server["host"], server["port"]), timeout=0.5)
+    except (OSError, ValueError, KeyError):
+        # a stale server.json (daemon killed) falls back to direct mode
+        return NOT_RUNNING
+    # long admits and exports are waited for
+    connection.settimeout(None)
+    message = {"token": server.get("token"), "command": command, "kwargs": kwargs}
+    connection.sendall((json.dumps(message) + "\n").encode())
+    return connection
+
+def running(bmdm_dir: str = ".bmdm"):
+    """
+    True if '.bmdm/server.json' points at a daemon that still accepts connections
+    """
+    server_file = f"{bmdm_dir}/server.json"
+    if not os.path.isfile(server_file):
+        return False
+    import socket
+    try:
+        with open(server_file, "r") as s_f:
+            server = json.load(s_f)
+        # an empty request is dropped by the daemon without a reply
+        socket.create_connection((server["host"], server["port"]), timeout=0.5).close()
+    except (OSError, ValueError, KeyError):
+        return False
+    return True
+
+def request(command: str, kwargs: dict, bmdm_dir: str = ".bmdm"):
+    """
+    To send a command to the running daemon, returns 'NOT_RUNNING' when there is none
+    """
+    if command not in SERVED_COMMANDS:
+        return NOT_RUNNING
+    connection = _send(command, kwargs, bmdm_dir)
+    if connection is NOT_RUNNING:
+        return NOT_RUNNING
+    with connection, connection.makefile("rb") as answer:
+        line = answer.readline()
+    if not line:
+        return NOT_RUNNING
+    return json.loads(line)
+
+def stream(command: str, kwargs: dict, bmdm_dir: str = ".bmdm"):
+    """
+    To run a generator command on the running daemon, returns an iterator over its items or 'NOT_RUNNING'
+    """
+    if command not in SERVED_STREAMS:
+        return NOT_RUNNING
+    connection = _send(command, kwargs, bmdm_dir)
+    if connection is NOT_RUNNING:
+        return NOT_RUNNING
+
+    def items():
+        # items are read as the daemon sends them, so the first ones arrive before the last are found
+        with connection, connection.makefile("rb") as answer:
+            for line in answer:
+                reply = json.loads(line)
+                if "item" in reply:
+                    yield reply["item"]
+                elif not reply["ok"]:
+                    _raise(reply)
+                else:
+                    return
+        raise RuntimeError("The daemon stopped while the command was running.")
+    return items()
+
+def _raise(reply: dict):
+    """
+    To raise the error of a reply again, with its original type where it is a builtin exception
+    """
+    error = getattr(builtins, reply.get("type", ""), None)
+    if not (isinstance(error, type) and issubclass(error, Exception)):
+        error = RuntimeError
+    raise error(reply["error"])
+
+def call(manager, command: str, **kwargs):
+    """
+    To run a manager command on the daemon if one is running, otherwise directly on 'manager'
+    * maintenance commands always run directly, and only when no daemon is running
+    """
+    if command in EXCLUSIVE_COMMANDS:
+        if running(manager.bmdm_dir):
+            raise RuntimeError(f"A BMDM daemon is running on this store, stop it before running '{command}'.")
+        return getattr(manager, command)(**kwargs)
+    if command in SERVED_STREAMS:
+        items = stream(command, kwargs, manager.bmdm_dir)
+        return getattr(manager, command)(**kwargs) if items is NOT_RUNNING else items
+    reply = request(command, kwargs, manager.bmdm_dir)
+    if reply is NOT_RUNNING:
+        return getattr(manager, command)(**kwargs)
+    if "confirm" in reply:
+        if console_prompt(reply["confirm"]):
+            reply = request(command, dict(kwargs, overwrite=True), manager.bmdm_dir)
+        else:
+            reply = request(command, dict(kwargs, overwrite=False), manager.bmdm_dir)
+            print('No changes were made.')
+        if reply is NOT_RUNNING:
+            raise RuntimeError("The daemon stopped while the command was running.")
+    if not reply["ok"]:
+        _raise(reply)
+    return reply["result"]
@@ -0,0 +1,797 @@
+# libraries
+import os
+import json
+from contextlib import contextmanager
+from bisect import bisect_left, insort
+
+# entries are keyed by full hashes, the shortest prefix an entry can also be found by
+PREFIX_SIZE = 8
+
+def date_key(value):
+    """
+    To normalise a study date to a sortable 'YYYYMMDD' key, None if it is not a full date
+    """
+    digits = "".join(c for c in str(value) if c.isdigit()) if value is not None else ""
+    return digits if len(digits) == 8 else None
+
+def date_bounds(study_date: tuple):
+    """
+    To turn a (start, end) study date range into inclusive 'YYYYMMDD' bounds, a missing side is open
+    * partial bounds are widened: '2024' as start is '20240101', as end it is '20241231'
+    """
+    start, end = study_date
+    start = "".join(c for c in start if c.isdigit()) if start else ""
+    end = "".join(c for c in end if c.isdigit()) if end else ""
+    return (start.ljust(8, "0")[:8] if start else None), (end.ljust(8, "9")[:8] if end else None)
+
+def apply_record(index_data: dict, record: dict):
+    """
+    To apply one journal record (admit, tag, untag, remove) to an index dict, replaying a record twice is harmless
+    """
+    op = record["op"]
+    key = record["key"]
+    if op == "admit":
+        index_data[key] = record["entry"]
+    elif op == "remove":
+        index_data.pop(key, None)
+    elif key in index_data:
+        if op == "tag":
+            index_data[key]["tags"][record["tag"]] = record["value"]
+        elif op == "untag":
+            index_data[key]["tags"].pop(record["tag"], None)
+
+def read_journal(journal_file: str, offset: int = 0):
+    """
+    To yield (record, size in bytes) for the complete journal records after 'offset'
+    """
+    with open(journal_file, "rb") as journal:
+        journal.seek(offset)
+        for line in journal:
+            # a record torn by a crash mid-write is the last line and is not replayed
+            if not line.endswith(b"\n"):
+                break
+            try:
+                record = json.loads(line)
+            except ValueError:
+                break
+            yield record, len(line)
+
+@contextmanager
+def journal_lock(journal_file: str, shared: bool = False):
+    """
+    To hold an exclusive lock on a journal ('<journal>.lock') across processes, writers take it from reading
+    the journal to the end of their append, so every byte past a writer's offset is a torn record of a crashed one
+    * a 'shared' lock may be held by many processes at once, only not together with an exclusive one (exclusive on Windows)
+    """
+    with open(f"{journal_file}.lock", "a+b") as lock_file:
+        if os.name == "nt":
+            import msvcrt
+            lock_file.seek(0)
+            msvcrt.locking(lock_file.fileno(), msvcrt.LK_LOCK, 1)
+        else:
+            import fcntl
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if os.name == "nt":
+                lock_file.seek(0)
+                msvcrt.locking(lock_file.fileno(), msvcrt.LK_UNLCK, 1)
+            else:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+
+def append_journal(journal_file: str, offset: int, records: list):
+    """
+    To durably append records to a journal whose complete records end at 'offset'
+    * the caller holds 'journal_lock' and has read the journal up to 'offset' under it
+    """
+    # a torn record left by a crashed writer is cut off so the new records start on a clean line
+    if os.path.isfile(journal_file) and os.path.getsize(journal_file) > offset:
+        with open(journal_file, "r+b") as journal:
+            journal.truncate(offset)
+    with open(journal_file, "a") as journal:
+        for record in records:
+            journal.write(json.dumps(record) + "\n")
+        journal.flush()
+        os.fsync(journal.fileno())
+
+def record_changes(current, records: list):
+    """
+    To get the (old entry, new entry) pair of every record, None standing for a missing entry
+    * 'current' is a callable(key) -> entry or None giving the state before the records
+    """
+    overlay = {}
+    changes = []
+    for record in records:
+        key = record["key"]
+        if key not in overlay:
+            overlay[key] = current(key)
+        old = overlay[key]
+        if old is not None:
+            # entries are copied, so the caller's index is never changed here
+            old = dict(old, tags=dict(old.get("tags", {})))
+        state = {} if old is None else {key: dict(old, tags=dict(old["tags"]))}
+        apply_record(state, record)
+        overlay[key] = state.get(key)
+        changes.append((old, overlay[key]))
+    return changes
+
+class Aggregates:
+    """
+    # Running totals over the index, persisted in '.bmdm/stats.json'
+    * entry count, entries per patient, per modality, per tag key and value, and per study month
+    * the stores update it with every mutation, so reading it does not touch the entries
+    * Method 'update': to move an entry from its old to its new state
+    * Method 'summary': to get the totals as a dict, with or without the breakdowns
+    """
+    def __init__(self, stats_file: str):
+        self.stats_file = stats_file
+        self.state = None
+        self.data = self.empty()
+
+    @staticmethod
+    def empty():
+        return {"entries": 0, "patients": {}, "modalities": {}, "tags": {}, "study_dates": {}}
+
+    @staticmethod
+    def _count(counts: dict, key, step: int):
+        key = str(key)
+        counts[key] = counts.get(key, 0) + step
+        if counts[key] <= 0:
+            del counts[key]
+
+    def _add(self, entry: dict, step: int):
+        self.data["entries"] += step
+        self._count(self.data["patients"], entry.get("patient_id"), step)
+        self._count(self.data["modalities"], entry.get("modality"), step)
+        key = date_key(entry.get("study_date"))
+        # the histogram has one bucket per month
+        self._count(self.data["study_dates"], f"{key[:4]}-{key[4:6]}" if key else "unknown", step)
+        for tag, value in entry.get("tags", {}).items():
+            values = self.data["tags"].setdefault(tag, {})
+            self._count(values, value, step)
+            if not values:
+                del self.data["tags"][tag]
+
+    def update(self, old: dict, new: dict):
+        if old is not None:
+            self._add(old, -1)
+        if new is not None:
+            self._add(new, 1)
+
+    def rebuild(self, items):
+        """
+        To recount everything from (hash, entry) pairs
+        """
+        self.data = self.empty()
+        for _, entry in items:
+            self._add(entry, 1)
+
+    def read(self):
+        """
+        To read the persisted totals, returns the index state they belong to (None if there are none)
+        """
+        if not os.path.isfile(self.stats_file):
+            return None
+        try:
+            with open(self.stats_file, "r") as s_f:
+                stored = json.load(s_f)
+        except ValueError:
+            return None
+        self.data = stored["aggregates"]
+        self.state = stored["state"]
+        return self.state
+
+    def save(self, state: list):
+        """
+        To persist the totals with the index state they belong to
+        """
+        self.state = state
+        # the temp name is unique per process, so concurrent writers never move each other's file
+        temp_file = f"{self.stats_file}.{os.getpid()}.tmp"
+        with open(temp_file, "w") as s_f:
+            json.dump({"state": state, "aggregates": self.data}, s_f)
+        os.replace(temp_file, self.stats_file)
+
+    def summary(self, detailed: bool = False):
+        data = self.data
+        if detailed:
+            return {
+                "total_entries": data["entries"],
+                "patients": dict(data["patients"]),
+                "modalities": dict(data["modalities"]),
+                "tags": {tag: dict(values) for tag, values in data["tags"].items()},
+                "study_dates": dict(sorted(data["study_dates"].items()))
+            }
+        return {
+            "total_entries": data["entries"],
+            "patients": len(data["patients"]),
+            "modalities": sorted(data["modalities"]),
+            "tags": sorted(data["tags"])
+        }
+
+def open_store(bmdm_dir: str = ".bmdm"):
+    """
+    To open the index backend that is in use in 'bmdm_dir' (compact index or SQLite once migrated, otherwise index.json)
+    """
+    if os.path.isfile(f"{bmdm_dir}/index.bin"):
+        # imported here, so sessions on the other backends do not pay for it
+        from compact_bmdm import CompactIndexStore
+        return CompactIndexStore(bmdm_dir)
+    if os.path.isfile(f"{bmdm_dir}/{SqliteIndexStore.db_name}"):
+        return SqliteIndexStore(bmdm_dir)
+    return JsonIndexStore(bmdm_dir)
+
+def _hashable(value):
+    """
+    True if 'value' can key a dict, list or dict values (e.g. from an admitted JSON file) can not
+    """
+    try:
+        hash(value)
+    except TypeError:
+        return False
+    return True
+
+class SecondaryIndex:
+    """
+    # In-memory hash indexes over the entries of an index
+    * filename, patient_id, study_date, modality and tag (key, value) map to the set of hashes having them
+    * a list or dict value is left out of the maps, no filter value can equal it
+    * study dates are also kept in a sorted list of (YYYYMMDD, position, hash) for range queries
+    * hashes are also grouped by their first PREFIX_SIZE characters, for lookups by a short hash
+    * Method 'candidates': to get the hashes matching some filters, in index order (date order for date ranges)
+    """
+    fields = ("filename", "patient_id", "study_date", "modality")
+    def __init__(self, index_data: dict):
+        self.maps = {field: {} for field in self.fields}
+        self.tags = {}
+        self.dates = []
+        # position of every hash in the index, to give results back in index order
+        self.positions = {}
+        self.prefixes = {}
+        self.counter = 0
+        for h, entry in index_data.items():
+            self.add(h, entry, sort=False)
+        # the dates of a whole index are sorted once, not inserted one by one
+        self.dates.sort()
+
+    def add(self, h: str, entry: dict, sort: bool = True):
+        if h not in self.positions:
+            self.positions[h] = self.counter
+            self.counter += 1
+            self.prefixes.setdefault(h[:PREFIX_SIZE], set()).add(h)
+        for field in self.fields:
+            if _hashable(entry.get(field)):
+                self.maps[field].setdefault(entry.get(field), set()).add(h)
+        key = date_key(entry.get("study_date"))
+        if key is not None:
+            if sort:
+                insort(self.dates, (key, self.positions[h], h))
+            else:
+                self.dates.append((key, self.positions[h], h))
+        for tag in entry.get("tags", {}).items():
+            if _hashable(tag):
+                self.tags.setdefault(tag, set()).add(h)
+
+    def discard(self, h: str, entry: dict):
+        for field in self.fields:
+            hashes = self.maps[field].get(entry.get(field)) if _hashable(entry.get(field)) else None
+            if hashes is not None:
+                hashes.discard(h)
+                if not hashes:
+                    del self.maps[field][entry.get(field)]
+        key = date_key(entry.get("study_date"))
+        if key is not None:
+            i = bisect_left(self.dates, (key, self.positions[h], h))
+            if i < len(self.dates) and self.dates[i][2] == h:
+                del self.dates[i]
+        for tag in entry.get("tags", {}).items():
+            hashes = self.tags.get(tag) if _hashable(tag) else None
+            if hashes is not None:
+                hashes.discard(h)
+                if not hashes:
+                    del self.tags[tag]
+
+    def with_prefix(self, prefix: str):
+        """
+        To get the hashes starting with 'prefix' (at least PREFIX_SIZE characters), in index order
+        """
+        hashes = [h for h in self.prefixes.get(prefix[:PREFIX_SIZE], ()) if h.startswith(prefix)]
+        return sorted(hashes, key=self.positions.__getitem__)
+
+    def candidates(self, filename=None, patient_id=None, study_date=None, modality=None, tag=None):
+        """
+        To intersect the hash sets of the given filters (smallest first), None means there is no filter
+        """
+        sets = []
+        date_range = None
+        if isinstance(study_date, tuple):
+            date_range = self.date_range(study_date)
+            study_date = None
+        for field, value in zip(self.fields, (filename, patient_id, study_date, modality)):
+            if value:
+                sets.append(self.maps[field].get(value, set()) if _hashable(value) else set())
+        if tag:
+            key, value = tag.split('=', 1)
+            sets.append(self.tags.get((key, value), set()))
+        if not sets:
+            return date_range
+        sets.sort(key=len)
+        result = set(sets[0])
+        for hashes in sets[1:]:
+            if not result:
+                break
+            result &= hashes
+        if date_range is not None:
+            return [h for h in date_range if h in result]
+        return sorted(result, key=self.positions.__getitem__)
+
+    def date_range(self, study_date: tuple):
+        """
+        To get the hashes whose study date is within (start, end), in date order, with two bisections
+        """
+        start, end = date_bounds(study_date)
+        low = bisect_left(self.dates, (start,)) if start else 0
+        high = bisect_left(self.dates, (end, float("inf"))) if end else len(self.dates)
+        return [h for _, _, h in self.dates[low:high]]
+
+class JsonIndexStore:
+    """
+    # Index stored as an 'index.json' snapshot plus an append-only journal of mutations
+    * The index is loaded once per session and kept up to date with the journal
+    * Method 'load': to read the whole index as {hash: entry}
+    * Method 'get': to get one entry by its hash (None if it is not indexed)
+    * Method 'with_prefix': to get the hashes starting with a short hash of at least PREFIX_SIZE characters
+    * Method 'query': to get the (hash, entry) pairs matching some filters ('iter_query' to stream them, 'count' to count them)
+    * Method 'apply': to durably record a list of mutations
+    * Method 'compact': to fold the journal into a new snapshot
+    * Method 'aggregates': to get the running totals of the index (see 'Aggregates')
+    """
+    name = "json"
+    # the journal is folded into index.json once it grows past this size (bytes)
+    journal_limit = 4 * 1024 * 1024
+    def __init__(self, bmdm_dir: str = ".bmdm"):
+        self.index_file = f"{bmdm_dir}/index.json"
+        self.journal_file = f"{bmdm_dir}/index.journal"
+        # session cache: the index dict, the snapshot it came from and how much of the journal was replayed
+        self.index_data = None
+        self.snapshot = None
+        self.journal_offset = 0
+        self.secondary = None
+        self.totals = Aggregates(f"{bmdm_dir}/stats.json")
+
+    @staticmethod
+    def _signature(path: str):
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            return None
+        return stat.st_mtime_ns, stat.st_size
+
+    def _apply(self, record: dict):
+        """
+        To apply a record to the cached index and its secondary indexes
+        """
+        if self.secondary is None:
+            apply_record(self.index_data, record)
+            return
+        key = record["key"]
+        if key in self.index_data:
+            self.secondary.discard(key, self.index_data[key])
+            if record["op"] == "remove":
+                del self.secondary.positions[key]
+                prefixed = self.secondary.prefixes[key[:PREFIX_SIZE]]
+                prefixed.discard(key)
+                if not prefixed:
+                    del self.secondary.prefixes[key[:PREFIX_SIZE]]
+        apply_record(self.index_data, record)
+        if key in self.index_data:
+            self.secondary.add(key, self.index_data[key])
+
+    def load(self):
+        """
+        To read the index snapshot and replay the journal on top of it
+        * only journal records written since the last call are replayed, unless the snapshot changed
+        """
+        snapshot = self._signature(self.index_file)
+        journal_size = os.path.getsize(self.journal_file) if os.path.isfile(self.journal_file) else 0
+        if self.index_data is None or snapshot != self.snapshot or journal_size < self.journal_offset:
+            with open(self.index_file, "r") as index:
+                self.index_data = json.load(index)
+            self.snapshot = snapshot
+            self.journal_offset = 0
+            self.secondary = None
+        if journal_size > self.journal_offset:
+            for record, size in read_journal(self.journal_file, self.journal_offset):
+                self._apply(record)
+                self.journal_offset += size
+        return self.index_data
+
+    def items(self):
+        """
+        To iterate over (hash, entry) pairs in index order
+        """
+        return iter(self.load().items())
+
+    def keys(self):
+        """
+        To get the set of hashes in the index
+        """
+        return set(self.load().keys())
+
+    def get(self, key: str):
+        return self.load().get(key)
+
+    def query(self, filename=None, patient_id=None, study_date=None, modality=None, tag=None):
+        """
+        To get the (hash, entry) pairs whose fields equal the given filters
+        * 'study_date' may also be a (start, end) range, then results are in date order
+        """
+        return list(self.iter_query(filename, patient_id, study_date, modality, tag))
+
+    def _secondary(self):
+        index_data = self.load()
+        if self.secondary is None:
+            self.secondary = SecondaryIndex(index_data)
+        return self.secondary
+
+    def with_prefix(self, prefix: str):
+        return self._secondary().with_prefix(prefix)
+
+    def _candidates(self, filename, patient_id, study_date, modality, tag):
+        return self._secondary().candidates(filename, patient_id, study_date, modality, tag)
+
+    def iter_query(self, filename=None, patient_id=None, study_date=None, modality=None, tag=None):
+        """
+        To iterate over the matches of 'query' without building the list
+        """
+        hashes = self._candidates(filename, patient_id, study_date, modality, tag)
+        index_data = self.index_data
+        if hashes is None:
+            yield from list(index_data.items())
+            return
+        for h in hashes:
+            # an entry removed while the results are consumed is skipped
+            if h in index_data:
+                yield h, index_data[h]
+
+    def count(self, filename=None, patient_id=None, study_date=None, modality=None, tag=None):
+        """
+        To count the matches of 'query' without reading the entries
+        """
+        hashes = self._candidates(filename, patient_id, study_date, modality, tag)
+        return len(self.index_data) if hashes is None else len(hashes)
+
+    def state(self):
+        """
+        To get a cheap signature of the index files, it changes with every write
+        """
+        journal_size = os.path.getsize(self.journal_file) if os.path.isfile(self.journal_file) else 0
+        return ["json", list(self._signature(self.index_file) or []), journal_size]
+
+    def aggregates(self):
+        """
+        To get the running totals, recounted only when they do not belong to the current index (e.g. after a crash)
+        """
+        # another process may have written since, its saved totals are read before anything is recounted
+        if self.totals.state != self.state():
+            self.totals.read()
+        if self.totals.state != self.state():
+            self.totals.rebuild(self.items())
+            self.totals.save(self.state())
+        return self.totals
+
+    def apply(self, records: list):
+        """
+        To append index mutations to the journal, they are durable once this returns
+        """
+        # other processes append to the same journal, so it is read and written under one lock
+        with journal_lock(self.journal_file):
+            index_data = self.load()
+            totals = self.aggregates()
+            changes = record_changes(index_data.get, records)
+            append_journal(self.journal_file, self.journal_offset, records)
+            # the new records are replayed into the session cache
+            self.load()
+            for old, new in changes:
+                totals.update(old, new)
+            totals.save(self.state())
+        if self.journal_offset > self.journal_limit:
+            self.compact()
+
+    def compact(self):
+        """
+        To fold the journal into a fresh index.json snapshot and clear it, returns the number of entries
+        """
+        with journal_lock(self.journal_file):
+            return self._compact()
+
+    def _compact(self):
+        index_data = self.load()
+        in_sync = self.totals.state is not None and self.totals.state == self.state()
+        # the snapshot is written next to the old one and swapped in atomically
+        temp_file = f"{self.index_file}.tmp"
+        with open(temp_file, "w") as index:
+            json.dump(index_data, index, indent=4)
+            index.flush()
+            os.fsync(index.fileno())
+        os.replace(temp_file, self.index_file)
+        # the journal is only cleared once the new snapshot is safely in place (replaying it again is harmless)
+        with open(self.journal_file, "w") as journal:
+            journal.flush()
+            os.fsync(journal.fileno())
+        self.snapshot = self._signature(self.index_file)
+        self.journal_offset = 0
+        # the totals did not change, only the files they are tied to
+        if in_sync:
+            self.totals.save(self.state())
+        return len(index_data)
+
+class SqliteIndexStore:
+    """
+    # Index stored in an SQLite database ('index.db') with indexed lookup columns and a separate tags table
+    * It has the same methods as 'JsonIndexStore'
+    """
+    name = "sqlite"
+    db_name = "index.db"
+    schema = """
+        CREATE TABLE IF NOT EXISTS entries (
+            key TEXT PRIMARY KEY,
+            filename TEXT,
+            patient_id TEXT,
+            study_date TEXT,
+            modality TEXT,
+            date_key TEXT,
+            data TEXT NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS tags (
+            key TEXT NOT NULL REFERENCES entries(key) ON DELETE CASCADE,
+            tag TEXT NOT NULL,
+            value TEXT,
+            PRIMARY KEY (key, tag)
+        );
+        CREATE INDEX IF NOT EXISTS entries_patient_id ON entries(patient_id);
+        CREATE INDEX IF NOT EXISTS entries_filename ON entries(filename);
+        CREATE INDEX IF NOT EXISTS entries_study_date ON entries(study_date);
+        CREATE INDEX IF NOT EXISTS entries_modality ON entries(modality);
+        CREATE INDEX IF NOT EXISTS entries_date_key ON entries(date_key);
+        CREATE INDEX IF NOT EXISTS tags_tag_value ON tags(tag, value);
+        CREATE TABLE IF NOT EXISTS meta (
+            name TEXT PRIMARY KEY,
+            value INTEGER NOT NULL
+        );
+    """
+    def __init__(self, bmdm_dir: str = ".bmdm", db_file: str = None):
+        # imported here, so sessions on index.json do not pay for it
+        import sqlite3
+        self.db_file = db_file or f"{bmdm_dir}/{self.db_name}"
+        # writers lock 'index.db.lock', also while a migration builds the database aside
+        self.lock_file = f"{bmdm_dir}/{self.db_name}"
+        self.totals = Aggregates(f"{bmdm_dir}/stats.json")
+        self.connection = sqlite3.connect(self.db_file)
+        self.connection.execute("PRAGMA foreign_keys = ON")
+        self.connection.execute("PRAGMA journal_mode = WAL")
+        self._upgrade()
+        self.connection.executescript(self.schema)
+
+    def _upgrade(self):
+        """
+        To add the normalised 'date_key' column to databases created before it existed
+        """
+        columns = [row[1] for row in self.connection.execute("PRAGMA table_info(entries)")]
+        if columns and "date_key" not in columns:
+            with self.connection:
+                self.connection.execute("ALTER TABLE entries ADD COLUMN date_key TEXT")
+                rows = self.connection.execute("SELECT key, study_date FROM entries").fetchall()
+                self.connection.executemany("UPDATE entries SET date_key = ? WHERE key = ?", [(date_key(d), k) for k, d in rows])
+
+    def close(self):
+        self.connection.close()
+
+    def _entries(self, rows):
+        """
+        To turn (key, data) rows into (hash, entry) pairs with their tags
+        """
+        rows = list(rows)
+        tags = {key: {} for key, _ in rows}
+        keys = list(tags)
+        # sqlite limits the number of bound parameters, so tags are fetched in slices
+        for start in range(0, len(keys), 500):
+            part = keys[start:start + 500]
+            for key, tag, value in self.connection.execute(
+                f"SELECT key, tag, value FROM tags WHERE key IN ({','.join('?' * len(part))}) ORDER BY rowid", part
+            ):
+                tags[key][tag] = value
+        results = []
+        for key, data in rows:
+            entry = json.loads(data)
+            entry["tags"] = tags[key]
+            results.append((key, entry))
+        return results
+
+    def load(self):
+        return dict(self.items())
+
+    def items(self):
+        cursor = self.connection.execute("SELECT key, data FROM entries ORDER BY rowid")
+        while True:
+            rows = cursor.fetchmany(1000)
+            if not rows:
+                break
+            yield from self._entries(rows)
+
+    def keys(self):
+        return {key for key, in self.connection.execute("SELECT key FROM entries")}
+
+    def _where(self, filename, patient_id, study_date, modality, tag):
+        """
+        To turn query filters into a WHERE clause, its parameters and the result order
+        """
+        where = []
+        params = []
+        order = " ORDER BY rowid"
+        if isinstance(study_date, tuple):
+            start, end = date_bounds(study_date)
+            where.append("entries.date_key IS NOT NULL")
+            if start:
+                where.append("entries.date_key >= ?")
+                params.append(start)
+            if end:
+                where.append("entries.date_key <= ?")
+                params.append(end)
+            order = " ORDER BY entries.date_key, rowid"
+            study_date = None
+        for column, value in (("filename", filename), ("patient_id", patient_id), ("study_date", study_date), ("modality", modality)):
+            if value:
+                where.append(f"entries.{column} = ?")
+                params.append(value)
+        if tag:
+            key, value = tag.split('=', 1)
+            where.append("entries.key IN (SELECT key FROM tags WHERE tag = ? AND value = ?)")
+            params.extend([key, value])
+        return (" WHERE " + " AND ".join(where) if where else ""), params, order
+
+    def query(self, filename=None, patient_id=None, study_date=None, modality=None, tag=None):
+        return list(self.iter_query(filename, patient_id, study_date, modality, tag))
+
+    def iter_query(self, filename=None, patient_id=None, study_date=None, modality=None, tag=None):
+        where, params, order = self._where(filename, patient_id, study_date, modality, tag)
+        cursor = self.connection.execute("SELECT key, data FROM entries" + where + order, params)
+        # rows are fetched and decoded in slices, so the first results come before the last are read
+        while True:
+            rows = cursor.fetchmany(500)
+            if not rows:
+                break
+            yield from self._entries(rows)
+
+    def count(self, filename=None, patient_id=None, study_date=None, modality=None, tag=None):
+        where, params, _ = self._where(filename, patient_id, study_date, modality, tag)
+        return self.connection.execute("SELECT COUNT(*) FROM entries" + where, params).fetchone()[0]
+
+    def _entry(self, key: str):
+        entries = self._entries(self.connection.execute("SELECT key, data FROM entries WHERE key = ?", (key,)))
+        return entries[0][1] if entries else None
+
+    def get(self, key: str):
+        return self._entry(key)
+
+    def with_prefix(self, prefix: str):
+        # a key range over the primary key, the table is never scanned
+        end = prefix[:-1] + chr(ord(prefix[-1]) + 1)
+        return [key for key, in self.connection.execute("SELECT key FROM entries WHERE key >= ? AND key < ? ORDER BY rowid", (prefix, end))]
+
+    def state(self):
+        """
+        To get the write generation of the database, every 'apply' increments it
+        """
+        row = self.connection.execute("SELECT value FROM meta WHERE name = 'generation'").fetchone()
+        return ["sqlite", row[0] if row else 0]
+
+    def aggregates(self):
+        # another process may have written since, its saved totals are read before anything is recounted
+        if self.totals.state != self.state():
+            self.totals.read()
+        if self.totals.state != self.state():
+            self.totals.rebuild(self.items())
+            self.totals.save(self.state())
+        return self.totals
+
+    def apply(self, records: list):
+        """
+        To apply index mutations in one transaction
+        """
+        # other processes write the same database and totals, so both are read and written under one lock
+        with journal_lock(self.lock_file):
+            self._apply(records)
+
+    def _apply(self, records: list):
+        totals = self.aggregates()
+        changes = record_changes(self._entry, records)
+        with self.connection:
+            self.connection.execute(
+                "INSERT INTO meta (name, value) VALUES ('generation', 1) ON CONFLICT(name) DO UPDATE SET value = value + 1"
+            )
+            for record in records:
+                op = record["op"]
+                key = record["key"]
+                if op == "admit":
+                    entry = dict(record["entry"])
+                    tags = entry.pop("tags", {})
+                    # the lookup columns only hold strings, any other value (e.g. a list) is kept in 'data' alone
+                    columns = [value if isinstance(value, str) else None for value in (entry.get(field) for field in SecondaryIndex.fields)]
+                    self.connection.execute(
+                        """INSERT INTO entries (key, filename, patient_id, study_date, modality, date_key, data) VALUES (?, ?, ?, ?, ?, ?, ?)
+                        ON CONFLICT(key) DO UPDATE SET filename=excluded.filename, patient_id=excluded.patient_id,
+                        study_date=excluded.study_date, modality=excluded.modality, date_key=excluded.date_key, data=excluded.data""",
+                        (key, *columns, date_key(entry.get("study_date")), json.dumps(entry))
+                    )
+                    self.connection.execute("DELETE FROM tags WHERE key = ?", (key,))
+                    self.connection.executemany(
+                        "INSERT INTO tags (key, tag, value) VALUES (?, ?, ?)", [(key, t, v) for t, v in tags.items()]
+                    )
+                elif op == "remove":
+                    self.connection.execute("DELETE FROM entries WHERE key = ?", (key,))
+                elif op == "tag":
+                    if self.connection.execute("SELECT 1 FROM entries WHERE key = ?", (key,)).fetchone():
+                        self.connection.execute(
+                            "INSERT INTO tags (key, tag, value) VALUES (?, ?, ?) ON CONFLICT(key, tag) DO UPDATE SET value=excluded.value",
+                            (key, record["tag"], record["value"])
+                        )
+                elif op == "untag":
+                    self.connection.execute("DELETE FROM tags WHERE key = ? AND tag = ?", (key, record["tag"]))
+        for old, new in changes:
+            totals.update(old, new)
+        totals.save(self.state())
+
+    def compact(self):
+        """
+        To checkpoint the write-ahead log and rebuild the database file, returns the number of entries
+        """
+        self.connection.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        self.connection.execute("VACUUM")
+        return self.connection.execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+
+def migrate_index(bmdm_dir: str = ".bmdm", to: str = "sqlite"):
+    """
+    To convert the index of 'bmdm_dir' into the SQLite ('sqlite') or compact ('compact') backend, returns the number of entries
+    * the new index is built aside and moved into place, so a failed migration leaves the old one in use
+    * the files of a SQLite or compact source are deleted afterwards, index.json is kept for 'boot'
+    """
+    source = open_store(bmdm_dir)
+    totals = source.aggregates()
+    if to == "sqlite":
+        db_file = f"{bmdm_dir}/{SqliteIndexStore.db_name}"
+        temp_file = f"{db_file}.tmp"
+        if os.path.exists(temp_file):
+            os.remove(temp_file)
+        target = SqliteIndexStore(bmdm_dir, db_file=temp_file)
+        records = [{"op": "admit", "key": key, "entry": dict(entry)} for key, entry in source.items()]
+        target.apply(records)
+        target.connection.execute("PRAGMA journal_mode = DELETE")
+        target.close()
+        total = len(records)
+    elif to == "compact":
+        from compact_bmdm import CompactIndexStore, write_index
+        db_file = f"{bmdm_dir}/{CompactIndexStore.index_name}"
+        temp_file = f"{db_file}.new"
+        total = write_index(temp_file, source.items())
+    else:
+        raise RuntimeError(f"Unknown index backend '{to}'.")
+    os.replace(temp_file, db_file)
+    if to == "compact":
+        # the totals do not change, they are carried over instead of being recounted from the new file
+        target = CompactIndexStore(bmdm_dir)
+        target.totals.data = totals.data
+        target.totals.save(target.state())
+    if source.name == "sqlite":
+        source.close()
+        for suffix in ("", "-wal", "-shm", ".lock"):
+            if os.path.exists(source.db_file + suffix):
+                os.remove(source.db_file + suffix)
+    elif source.name == "compact":
+        source.close()
+        for path in (source.journal_file, f"{source.journal_file}.lock"):
+            if os.path.exists(path):
+                os.remove(path)
+        os.remove(source.index_file)
+    return total